@@ -0,0 +1,292 @@
+import math
+import types
+
+import numpy as np
+
+from swarmmath import normalize, clampElevation
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+# kinds of the (fish, target) pairs of computeInfluence, -1 : no influence
+PAIR_REPULSOR = 0
+PAIR_ALIGNER = 1
+PAIR_ATTRACTOR = 2
+
+
+def jitKernel(function):
+    # compiled by Numba (lazily, on first call) when it is installed
+    if numba is None:
+        return function
+    return numba.njit(cache=True)(function)
+
+
+def pythonKernel(kernel):
+    # the interpreted version of a kernel
+    return getattr(kernel, "py_func", kernel)
+
+
+# Loop kernels : plain Python over the arrays, one fish or pair at a time.
+# Run as is by the PythonBackend (reference of the SwarmEngine steps : forward
+# vectors, turn rate and elevation limits) and compiled by Numba for the NumbaBackend.
+
+@jitKernel
+def _clampElevation(x, y, z, limit):
+    # limit the up / down component of a unit direction, the heading is kept
+    z = min(limit, max(-limit, z))
+    horizontal = math.sqrt(x * x + y * y)
+    if horizontal < 1e-12:
+        return math.sqrt(1 - limit * limit), 0.0, z
+    scale = math.sqrt(1 - z * z) / horizontal
+    return x * scale, y * scale, z
+
+
+@jitKernel
+def _classifyLoop(distances, collisionRadius, alignRadius, attractRadius, kinds):
+    for i in range(len(distances)):
+        d = distances[i]
+        if d < collisionRadius:
+            kinds[i] = PAIR_REPULSOR
+        elif d < alignRadius:
+            kinds[i] = PAIR_ALIGNER
+        elif d < attractRadius:
+            kinds[i] = PAIR_ATTRACTOR
+        else:
+            kinds[i] = -1
+
+
+@jitKernel
+def _pairSteeringLoop(kinds, delta, forward, targetForward, cosFov, maxRadius, rotation, visible):
+    for i in range(len(kinds)):
+        rotation[i, 0] = 0.0
+        rotation[i, 1] = 0.0
+        rotation[i, 2] = 0.0
+        visible[i] = False
+        kind = kinds[i]
+        dx, dy, dz = delta[i, 0], delta[i, 1], delta[i, 2]
+        fx, fy, fz = forward[i, 0], forward[i, 1], forward[i, 2]
+        distance = math.sqrt(dx * dx + dy * dy + dz * dz)
+        # only what the fish can see : inside the FOV cone
+        if distance == 0 or fx * dx + fy * dy + fz * dz < cosFov * distance:
+            continue
+        if kind == PAIR_ALIGNER:
+            # swim along the same direction
+            tx, ty, tz = targetForward[i, 0], targetForward[i, 1], targetForward[i, 2]
+        else:
+            # and not too far
+            if distance > maxRadius:
+                continue
+            # towards attractors, away from repulsors
+            sign = 1.0 if kind == PAIR_ATTRACTOR else -1.0
+            tx, ty, tz = sign * dx / distance, sign * dy / distance, sign * dz / distance
+        visible[i] = True
+
+        # rotation vector turning the fish direction to the wanted one
+        cx, cy, cz = fy * tz - fz * ty, fz * tx - fx * tz, fx * ty - fy * tx
+        sinAngle = math.sqrt(cx * cx + cy * cy + cz * cz)
+        if sinAngle < 1e-12:
+            continue
+        scale = math.atan2(sinAngle, fx * tx + fy * ty + fz * tz) / sinAngle
+        rotation[i, 0] = cx * scale
+        rotation[i, 1] = cy * scale
+        rotation[i, 2] = cz * scale
+
+
+@jitKernel
+def _rotateLoop(forward, rotation, factor, maxAngle, elevationLimit):
+    # turn each direction by its rotation vector, at most maxAngle (radians)
+    for i in range(len(forward)):
+        wx, wy, wz = rotation[i, 0] * factor, rotation[i, 1] * factor, rotation[i, 2] * factor
+        angle = math.sqrt(wx * wx + wy * wy + wz * wz)
+        fx, fy, fz = forward[i, 0], forward[i, 1], forward[i, 2]
+        if angle > 1e-12:
+            ax, ay, az = wx / angle, wy / angle, wz / angle
+            angle = min(angle, maxAngle)
+            c, s = math.cos(angle), math.sin(angle)
+            # Rodrigues rotation
+            dot = (ax * fx + ay * fy + az * fz) * (1 - c)
+            fx, fy, fz = (fx * c + (ay * fz - az * fy) * s + ax * dot,
+                          fy * c + (az * fx - ax * fz) * s + ay * dot,
+                          fz * c + (ax * fy - ay * fx) * s + az * dot)
+        # fish are not supposed to swim vertically (FishActor.safeSetHpr)
+        fx, fy, fz = _clampElevation(fx, fy, fz, elevationLimit)
+        forward[i, 0] = fx
+        forward[i, 1] = fy
+        forward[i, 2] = fz
+
+
+@jitKernel
+def _turnTowardsLoop(forward, target, move, fraction):
+    # boundary steering : turn the directions by a fraction of their angle to the targets
+    for i in range(len(forward)):
+        if not move[i]:
+            continue
+        fx, fy, fz = forward[i, 0], forward[i, 1], forward[i, 2]
+        tx, ty, tz = target[i, 0], target[i, 1], target[i, 2]
+        cx, cy, cz = fy * tz - fz * ty, fz * tx - fx * tz, fx * ty - fy * tx
+        sinAngle = math.sqrt(cx * cx + cy * cy + cz * cz)
+        angle = math.atan2(sinAngle, fx * tx + fy * ty + fz * tz) * min(fraction[i], 1.0)
+        if sinAngle < 1e-12:
+            # already there, or right behind : turn horizontally
+            cx, cy, cz = -fy, fx, 0.0
+            sinAngle = math.sqrt(cx * cx + cy * cy)
+            if sinAngle < 1e-12 or angle == 0:
+                continue
+        ax, ay, az = cx / sinAngle, cy / sinAngle, cz / sinAngle
+        c, s = math.cos(angle), math.sin(angle)
+        # the axis is perpendicular to the direction
+        fx, fy, fz = (fx * c + (ay * fz - az * fy) * s,
+                      fy * c + (az * fx - ax * fz) * s,
+                      fz * c + (ax * fy - ay * fx) * s)
+        norm = math.sqrt(fx * fx + fy * fy + fz * fz)
+        forward[i, 0] = fx / norm
+        forward[i, 1] = fy / norm
+        forward[i, 2] = fz / norm
+
+
+LOOP_KERNELS = ("_classifyLoop", "_pairSteeringLoop", "_rotateLoop", "_turnTowardsLoop")
+
+
+def interpretedKernels(names):
+    # with Numba installed the py_func of a kernel still calls the compiled helpers
+    # it finds in the module (_clampElevation) : the kernels are rebuilt over a
+    # namespace where every kernel is interpreted
+    namespace = {name: pythonKernel(value) for name, value in globals().items()}
+    return [types.FunctionType(namespace[name].__code__, namespace, name) for name in names]
+
+
+class LoopBackend:
+
+    # Kernels of the swarm behaviour written as loops (see above).
+
+    def __init__(self, kernels):
+        self.classifyLoop, self.pairSteeringLoop, self.rotateLoop, self.turnTowardsLoop = kernels
+
+    def __reduce__(self):
+        # built again in the worker processes : with numba installed the module
+        # level kernels are dispatchers, their py_func can not be pickled by name
+        return (type(self), ())
+
+    def classifyNeighbours(self, distances, collisionRadius, alignRadius, attractRadius):
+        kinds = np.empty(len(distances), dtype=np.int64)
+        self.classifyLoop(np.ascontiguousarray(distances, dtype=np.float64),
+                          collisionRadius, alignRadius, attractRadius, kinds)
+        return kinds
+
+    def pairSteering(self, kinds, delta, forward, targetForward, fov, maxRadius):
+        rotation = np.empty((len(kinds), 3))
+        visible = np.empty(len(kinds), dtype=np.bool_)
+        self.pairSteeringLoop(kinds, np.ascontiguousarray(delta), np.ascontiguousarray(forward),
+                              np.ascontiguousarray(targetForward), math.cos(math.radians(fov)),
+                              float(maxRadius), rotation, visible)
+        return rotation, visible
+
+    def rotate(self, forward, rotation, factor, maxAngle, maxElevation):
+        forward = np.array(forward, dtype=np.float64)
+        self.rotateLoop(forward, np.ascontiguousarray(rotation), float(factor), float(maxAngle),
+                        math.sin(math.radians(maxElevation)))
+        return forward
+
+    def turnTowards(self, forward, target, move, fraction):
+        self.turnTowardsLoop(forward, np.ascontiguousarray(target), np.ascontiguousarray(move),
+                             np.ascontiguousarray(fraction, dtype=np.float64))
+
+
+class PythonBackend(LoopBackend):
+
+    # reference backend : the loop kernels interpreted, no dependency
+    name = "python"
+
+    def __init__(self):
+        LoopBackend.__init__(self, interpretedKernels(LOOP_KERNELS))
+
+
+class NumbaBackend(LoopBackend):
+
+    # the loop kernels compiled by Numba (optional dependency)
+    name = "numba"
+
+    def __init__(self):
+        if numba is None:
+            raise ImportError("numba is not installed")
+        LoopBackend.__init__(self, [globals()[name] for name in LOOP_KERNELS])
+
+
+class NumpyBackend:
+
+    # batched numpy operations over all the pairs / fish at once
+
+    name = "numpy"
+
+    def classifyNeighbours(self, distances, collisionRadius, alignRadius, attractRadius):
+        kinds = np.full(len(distances), -1, dtype=np.int64)
+        kinds[distances < attractRadius] = PAIR_ATTRACTOR
+        kinds[distances < alignRadius] = PAIR_ALIGNER
+        kinds[distances < collisionRadius] = PAIR_REPULSOR
+        return kinds
+
+    def pairSteering(self, kinds, delta, forward, targetForward, fov, maxRadius):
+        distance = np.linalg.norm(delta, axis=1)
+        # only what the fish can see : inside the FOV cone
+        visible = (distance > 0) & (np.einsum("ij,ij->i", forward, delta) >= np.cos(np.radians(fov)) * distance)
+        align = kinds == PAIR_ALIGNER
+        # and not too far
+        visible &= align | (distance <= maxRadius)
+
+        # swim along aligners, towards attractors, away from repulsors
+        sign = np.where(kinds == PAIR_ATTRACTOR, 1.0, -1.0)
+        wanted = delta * (sign / np.maximum(distance, 1e-12))[:, None]
+        wanted[align] = targetForward[align]
+
+        # rotation vector turning the fish direction to the wanted one
+        cross = np.cross(forward, wanted)
+        sinAngle = np.linalg.norm(cross, axis=1)
+        angle = np.arctan2(sinAngle, np.einsum("ij,ij->i", forward, wanted))
+        rotation = cross * (angle / np.maximum(sinAngle, 1e-12))[:, None]
+        rotation[~visible | (sinAngle < 1e-12)] = 0
+        return rotation, visible
+
+    def rotate(self, forward, rotation, factor, maxAngle, maxElevation):
+        rotation = rotation * factor
+        angle = np.linalg.norm(rotation, axis=1)
+        axis = rotation / np.maximum(angle, 1e-12)[:, None]
+        angle = np.minimum(angle, maxAngle)[:, None]
+        # Rodrigues rotation
+        dot = np.einsum("ij,ij->i", axis, forward)[:, None]
+        rotated = forward * np.cos(angle) + np.cross(axis, forward) * np.sin(angle) + axis * dot * (1 - np.cos(angle))
+        # fish are not supposed to swim vertically (FishActor.safeSetHpr)
+        return clampElevation(rotated, maxElevation)
+
+    def turnTowards(self, forward, target, move, fraction):
+        cross = np.cross(forward, target)
+        sinAngle = np.linalg.norm(cross, axis=1)
+        angle = np.arctan2(sinAngle, np.einsum("ij,ij->i", forward, target)) * np.minimum(fraction, 1)
+        # already there, or right behind : turn horizontally
+        behind = sinAngle < 1e-12
+        cross[behind] = np.stack([-forward[behind, 1], forward[behind, 0], np.zeros(np.count_nonzero(behind))], axis=1)
+        sinAngle = np.linalg.norm(cross, axis=1)
+        move = move & (sinAngle >= 1e-12) & (angle != 0)
+        axis = cross[move] / sinAngle[move, None]
+        angle = angle[move, None]
+        # the axis is perpendicular to the direction
+        forward[move] = normalize(forward[move] * np.cos(angle) + np.cross(axis, forward[move]) * np.sin(angle))
+
+
+BACKENDS = {"numpy": NumpyBackend, "python": PythonBackend, "numba": NumbaBackend}
+
+
+def selectBackend(name="auto"):
+    # "auto" : numba when installed, numpy otherwise
+    if name == "auto":
+        name = "numba" if numba is not None else "numpy"
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown compute backend {name} (choose from auto, {', '.join(BACKENDS)})")
+    try:
+        backend = BACKENDS[name]()
+    except ImportError as e:
+        print(f"{name} backend not available ({e}), using the numpy backend")
+        backend = NumpyBackend()
+    print(f"compute backend : {backend.name}")
+    return backend
@@ -11,28 +11,53 @@ import math
 import sys
 from panda3d.core import Point3, TransparencyAttrib,TextNode
 from direct.gui.DirectGui import DirectFrame, DirectButton, DGG, DirectCheckButton
+from direct.gui.OnscreenText import OnscreenText
 from panda3d.core import OrthographicLens,PerspectiveLens
 import os
+import time
 from panda3d.core import Filename
 
 from panda3d.core import getModelPath
 from panda3d.core import loadPrcFile
 
+from scheduler import FixedStepScheduler
+from profiler import PhaseProfiler, StartupTimer
+from modelcache import ModelCache
+
 
 loadPrcFile('settings.prc')
 
+# the simulation runs at a fixed rate, whatever the render frame rate
+SIMULATION_RATE=60
+# a slow frame runs at most this many simulation steps
+MAX_SUBSTEPS=4
+
+# file written when the profiler trace is stopped (.csv or .json)
+PROFILER_TRACE_FILE="swarm_trace.csv"
+
+# glTF models converted to .bam are cached there
+MODEL_CACHE_DIR=os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache")
+
 class BaseSimulation(ShowBase):
     
-    def __init__(self):
-        ShowBase.__init__(self)
-
+    def __init__(self, headless=False):
+        # headless : no window, no task driven simulation, the caller steps it
+        # durations of the startup phases, reported at the first frame
+        self.startup=StartupTimer()
+        with self.startup.phase("window"):
+            ShowBase.__init__(self, windowType='none' if headless else None)
+
+        self.headless=headless
         self.freeze=False
+        self.scheduler=FixedStepScheduler(SIMULATION_RATE, MAX_SUBSTEPS)
+        # per frame timings of the simulation phases
+        self.profiler=PhaseProfiler()
     
         self.lens2D=None
         self.lens3D=None
 
         self.models={}
-
+        self.modelCache=None
 
         current_dir = os.path.dirname(__file__)
         model_dir = os.path.join(current_dir, 'models')
@@ -42,27 +67,41 @@ class BaseSimulation(ShowBase):
         print(f"new ModelPath = {getModelPath()}")
 
         # Schedule the update task
-        self.taskMgr.add(self.runSimulation, "update simulation")
+        if not headless:
+            self.taskMgr.add(self.runSimulation, "update simulation")
+            # after the rendering of the first frame (igLoop)
+            self.taskMgr.add(self.reportStartup, "startup report", sort=55)
 
 
-    def loadModels(self, modelMappings):
-       
-        for modelName in modelMappings.keys():
-            modelDef = modelMappings[modelName]
-
-            path = modelDef["path"]
-            model = self.loader.loadModel(path)
-            self.models[modelName] = model
-
+    def loadModels(self, modelMappings, preload=()):
+        # the models are loaded on first use (getModel), the ones of preload
+        # start loading in the background now
         self.modelMappings=modelMappings
+        self.modelCache=ModelCache(self.loader.loader, MODEL_CACHE_DIR)
+        for modelName in preload:
+            self.modelCache.request(modelMappings[modelName]["path"])
 
     def getModel(self, modelName):
+        if modelName not in self.models and self.modelCache is not None and modelName in self.modelMappings:
+            self.models[modelName] = self.modelCache.get(self.modelMappings[modelName]["path"])
         return self.models.get(modelName, None)
     
     def getModelScaling(self, modelName):
         modelDef = self.modelMappings[modelName]
         return modelDef["scale"]
 
+    def showLoadingText(self, text):
+        # message rendered at once, while the rest of the scene is set up
+        loading = OnscreenText(text=text, pos=(0, 0), scale=0.08, fg=(1, 1, 1, 1), mayChange=True)
+        # both buffers of the window
+        for _ in range(2):
+            self.graphicsEngine.renderFrame()
+        return loading
+
+    def reportStartup(self, task):
+        self.startup.finish()
+        return task.done
+
     def setupLights(self):
         # Ambient Light
         ambientLight = AmbientLight("ambientLight")
@@ -120,6 +159,8 @@ class BaseSimulation(ShowBase):
         # Set up a key to toggle the drawer
         self.accept("space", self.toggleDrawer)
         self.accept("p", self.toggleFreeze)
+        self.accept("v", self.toggleDebugVectors)
+        self.accept("g", self.toggleGrid)
 
 
     def recordUserInput(self, input, value):
@@ -157,6 +198,18 @@ class BaseSimulation(ShowBase):
     def toggleFreeze(self, status=None):
         self.freeze = not self.freeze
 
+    def toggleDebugVectors(self, status=None):
+        pass
+
+    def toggleGrid(self, status=None):
+        pass
+
+    def toggleProfilerTrace(self, status=None):
+        if self.profiler.isTracing():
+            self.profiler.stopTrace(PROFILER_TRACE_FILE)
+        else:
+            self.profiler.startTrace()
+
     def setupCamera(self):
 
         self.set3DCamera()        
@@ -195,17 +248,47 @@ class BaseSimulation(ShowBase):
         self.cam.node().setLens(lens)   
 
     def runSimulation(self, task):
-        print("Implement 'BaseSimulation.runSimulation' ")
+
+        if self.freeze:
+            return task.cont
+
+        # fixed steps for the simulation, the scene is updated once per frame
+        steps = self.scheduler.advance(globalClock.getDt(), self.stepSimulation)
+        self.updateScene(self.scheduler.alpha)
+        self.profiler.count("steps", steps)
+        # simulated time given up by the substep cap (the simulation runs slower than real time)
+        self.profiler.count("droppedMs", self.scheduler.dropped * 1000)
+        self.profiler.endFrame()
+        return task.cont
+
+    def stepSimulation(self, dt):
+        print("Implement 'BaseSimulation.stepSimulation' ")
+
+    def updateScene(self, alpha):
+        # alpha : position of the frame between the last two simulation steps
+        pass
+
+    def runHeadless(self, steps, dt):
+        # step the simulation with a fixed dt as fast as possible
+        start = time.perf_counter()
+        for _ in range(steps):
+            self.stepSimulation(dt)
+            self.profiler.endFrame()
+        elapsed = time.perf_counter() - start
+        stepsPerSec = steps / elapsed if elapsed > 0 else float("inf")
+        print(f"{steps} steps (dt={dt}) in {elapsed:.3f}s => {stepsPerSec:.1f} steps/sec")
+        return stepsPerSec
 
 
 
 class BaseSimulationWithDrawer(BaseSimulation):
     
-    def __init__(self):
-        BaseSimulation.__init__(self)
+    def __init__(self, headless=False):
+        BaseSimulation.__init__(self, headless)
         self.orthographic=False
  
-    def setupDrawer(self):
+    def setupDrawer(self, displayVectors=False, displayGrid=False):
+        # displayVectors / displayGrid : initial state of the layers, shown by their checkboxes
       # Create a frame that acts as a drawer
         
         drawerPosition = -1.5
@@ -274,6 +357,38 @@ class BaseSimulationWithDrawer(BaseSimulation):
                                                   frameSize=btnSize)
 
 
+        self.vectorsCheckbox = DirectCheckButton(text = "Vectors" ,
+                                                  parent=self.drawer,
+                                                  scale=.05,
+                                                  command=self.toggleDebugVectors,
+                                                  indicatorValue=int(displayVectors),
+                                                  pos=(drawerPosition + margin , 0, 0.06),
+                                                  frameSize=btnSize)
+
+
+        self.gridCheckbox = DirectCheckButton(text = "Grid" ,
+                                                  parent=self.drawer,
+                                                  scale=.05,
+                                                  command=self.toggleGrid,
+                                                  indicatorValue=int(displayGrid),
+                                                  pos=(drawerPosition + margin , 0, -0.05),
+                                                  frameSize=btnSize)
+
+
+        self.traceCheckbox = DirectCheckButton(text = "Trace" ,
+                                                  parent=self.drawer,
+                                                  scale=.05,
+                                                  command=self.toggleProfilerTrace,
+                                                  pos=(drawerPosition + margin , 0, -0.16),
+                                                  frameSize=btnSize)
+
+        # rolling stats of the profiler
+        self.profilerText = OnscreenText(text="", parent=self.drawer, scale=0.032,
+                                         pos=(drawerPosition + 0.03, -0.26), align=TextNode.ALeft,
+                                         fg=(1, 1, 1, 1), mayChange=True, font=self.loader.loadFont("cmtt12"))
+        self.taskMgr.doMethodLater(0.5, self.updateProfilerDisplay, "profiler display")
+
+
         self.resetButton = DirectButton(text="Reset", scale=0.05, 
                                           command=self.resetSimulation, parent=self.drawer,
                                           pos=(drawerPosition + margin , 0, 0.72),  # Adjust pos as needed
@@ -292,6 +407,11 @@ class BaseSimulationWithDrawer(BaseSimulation):
     def resetSimulation(self):
         pass
 
+    def updateProfilerDisplay(self, task):
+        if self.drawerOpen:
+            self.profilerText.setText(self.profiler.formatStats())
+        return task.again
+
     def toggleFreeze(self, status=None):
         self.freeze = not self.freeze
 
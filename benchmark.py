@@ -0,0 +1,179 @@
+import argparse
+import json
+import math
+import platform
+import subprocess
+import sys
+import time
+
+import numpy as np
+
+import swarm
+from swarm import FishTankSimulation, TANK_DIMENSION
+from swarmcore import CONFIG, gridLayout, triangleLayout
+from sharding import STATE_FIELDS
+
+# fraction of the tank used by the layouts
+FILL_RATIO = 0.9
+
+DEFAULT_SIZES = [100, 1000, 10000, 100000]
+LAYOUTS = ["grid", "triangle", "random"]
+PHASES = ["spatialDistribution", "neighbours", "computeInfluence", "stayInTank", "step"]
+
+
+def mkLayout(name, count, rng):
+    # count fish positions spread over the tank
+    width, length, height = (FILL_RATIO * d for d in TANK_DIMENSION)
+    if name == "grid":
+        # same proportions as the tank
+        w = max(1, math.ceil(math.sqrt(count * width / length)))
+        l = math.ceil(count / w)
+        spacing = 2 * min(width / w, length / l)
+        positions = gridLayout(w, l, spacing)
+    elif name == "triangle":
+        w = math.ceil((math.sqrt(8 * count + 1) - 1) / 2)
+        spacing = 2 * min(width, length) / w
+        positions = triangleLayout(w, w, spacing)
+    elif name == "random":
+        positions = rng.uniform(-1, 1, (count, 3)) * (width, length, height)
+    else:
+        raise ValueError(f"Unknown layout {name}")
+    return [tuple(p) for p in positions[:count]]
+
+
+def addEnvironmentObjects(app, count, rng):
+    # food pellets (attractors) and predators (repulsors) spread over the tank
+    for i in range(count):
+        node = app.render.attachNewNode(f"object_{i}")
+        node.setPos(*(rng.uniform(-1, 1, 3) * FILL_RATIO * np.array(TANK_DIMENSION)))
+        app.addEnvironmentObject("attractors" if i % 2 == 0 else "repulsors", node)
+
+
+def snapshot(engine):
+    return {field: getattr(engine, field).copy() for field, _ in STATE_FIELDS}
+
+
+def restore(engine, state):
+    for field, values in state.items():
+        getattr(engine, field)[:] = values
+
+
+def measure(setup, run, repeats):
+    # seconds of each run, setup is not timed
+    times = []
+    for _ in range(repeats):
+        setup()
+        start = time.perf_counter()
+        run()
+        times.append(time.perf_counter() - start)
+    return times
+
+
+def benchmarkSwarm(app, repeats, dt):
+    # time each phase of a step separately, always starting from the same swarm state
+    engine = app.swarmEngine
+    environment = app.getEnvironmentState()
+    k = CONFIG["neighbours"]
+
+    initial = snapshot(engine)
+    engine.step(dt, TANK_DIMENSION, environment)
+    moved = engine.pos.copy()
+    restore(engine, initial)
+
+    active = np.nonzero(engine.escapeTimeout <= 0)[0]
+    globalSpeed = engine.forward * (engine.speed * engine.scale)[:, None]
+    engine.grid.update(engine.pos)
+    neighbours = engine.neighbourQuery.kNearestBatch(engine.pos, active, k, engine.neighbourRadius())
+
+    def reset():
+        restore(engine, initial)
+
+    def resetGrid():
+        restore(engine, initial)
+        engine.grid.update(engine.pos)
+
+    timings = {}
+    # incremental update of the grid between two steps
+    timings["spatialDistribution"] = measure(resetGrid, lambda: engine.grid.update(moved), repeats)
+    timings["neighbours"] = measure(resetGrid, lambda: engine.neighbourQuery.kNearestBatch(
+        engine.pos, active, k, engine.neighbourRadius()), repeats)
+    examined = engine.neighbourQuery.examined
+    timings["computeInfluence"] = measure(reset, lambda: engine.computeInfluence(
+        active, neighbours, dt, environment), repeats)
+    timings["stayInTank"] = measure(reset, lambda: engine.stayInTank(
+        active, globalSpeed, TANK_DIMENSION, dt), repeats)
+    # FishTankSimulation.stepSimulation, as run by the simulation task
+    timings["step"] = measure(resetGrid, lambda: app.stepSimulation(dt), repeats)
+    restore(engine, initial)
+
+    return timings, examined
+
+
+def summarize(times):
+    return {
+        "min": min(times),
+        "median": float(np.median(times)),
+        "mean": float(np.mean(times)),
+        "repeats": len(times),
+    }
+
+
+def gitRevision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"], stderr=subprocess.DEVNULL, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def runBenchmark(sizes, layouts, repeats, dt, seed=0, objects=0):
+
+    swarm.USE_SWARM_ENGINE = True
+    app = FishTankSimulation(headless=True)
+    rng = np.random.default_rng(seed)
+    addEnvironmentObjects(app, objects, rng)
+
+    results = []
+    for layout in layouts:
+        for size in sizes:
+            app.setupSwarm(mkLayout(layout, size, rng))
+            timings, examined = benchmarkSwarm(app, repeats, dt)
+            for phase in PHASES:
+                stats = summarize(timings[phase])
+                results.append(dict(layout=layout, fish=app.swarmEngine.count, phase=phase, **stats))
+                print(f"{layout:>9} {app.swarmEngine.count:>7} fish  {phase:<20} "
+                      f"min {stats['min'] * 1000:9.3f} ms  median {stats['median'] * 1000:9.3f} ms")
+            results.append(dict(layout=layout, fish=app.swarmEngine.count, phase="neighboursExamined", value=examined))
+
+    app.swarmEngine.close()
+    app.destroy()
+
+    return {
+        "revision": gitRevision(),
+        "python": platform.python_version(),
+        "numpy": np.__version__,
+        "platform": platform.platform(),
+        "dt": dt,
+        "objects": objects,
+        "config": dict(CONFIG),
+        "results": results,
+    }
+
+
+def parseArguments(argv):
+    parser = argparse.ArgumentParser(description="Time the phases of a swarm step for several swarm sizes")
+    parser.add_argument("--sizes", type=int, nargs="+", default=DEFAULT_SIZES, help="number of fish of each swarm")
+    parser.add_argument("--layouts", nargs="+", choices=LAYOUTS, default=LAYOUTS, help="initial fish layouts")
+    parser.add_argument("--repeats", type=int, default=5, help="timed runs of each phase")
+    parser.add_argument("--dt", type=float, default=1/60, help="simulation time step (seconds)")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the random layout")
+    parser.add_argument("--objects", type=int, default=0, help="environment objects (attractors and repulsors) in the tank")
+    parser.add_argument("--output", default="benchmark.json", help="JSON result file")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    args = parseArguments(sys.argv[1:])
+    report = runBenchmark(args.sizes, args.layouts, args.repeats, args.dt, args.seed, args.objects)
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {args.output}")
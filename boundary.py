@@ -0,0 +1,270 @@
+import numpy as np
+
+from swarmcore import CONFIG
+from swarmmath import normAngles, fastestPaths, hprToDirections, directionsToHpr, clampElevation, MAX_ELEVATION
+
+# tank faces as (dimension, sign), same order as FishActor.stayInTank
+TANK_FACES = [(0, 1), (0, -1), (1, 1), (1, -1), (2, 1), (2, -1)]
+
+# size of the voxels of the distance field (world units)
+VOXEL_SIZE = 25
+
+
+# Shapes : signed distance of points to the shape, negative inside
+
+class BoxShape:
+
+    def __init__(self, halfExtents, center=(0, 0, 0)):
+        self.halfExtents = np.asarray(halfExtents, dtype=np.float64)
+        self.center = np.asarray(center, dtype=np.float64)
+
+    def bounds(self):
+        return self.center - self.halfExtents, self.center + self.halfExtents
+
+    def distance(self, points):
+        q = np.abs(points - self.center) - self.halfExtents
+        outside = np.linalg.norm(np.maximum(q, 0), axis=1)
+        inside = np.minimum(q.max(axis=1), 0)
+        return outside + inside
+
+
+class CylinderShape:
+
+    # vertical cylinder (axis along Z)
+
+    def __init__(self, radius, halfHeight, center=(0, 0, 0)):
+        self.radius = float(radius)
+        self.halfHeight = float(halfHeight)
+        self.center = np.asarray(center, dtype=np.float64)
+
+    def bounds(self):
+        halfExtents = np.array([self.radius, self.radius, self.halfHeight])
+        return self.center - halfExtents, self.center + halfExtents
+
+    def distance(self, points):
+        delta = points - self.center
+        q = np.stack([np.hypot(delta[:, 0], delta[:, 1]) - self.radius, np.abs(delta[:, 2]) - self.halfHeight], axis=1)
+        outside = np.linalg.norm(np.maximum(q, 0), axis=1)
+        inside = np.minimum(q.max(axis=1), 0)
+        return outside + inside
+
+
+class SphereShape:
+
+    def __init__(self, radius, center=(0, 0, 0)):
+        self.radius = float(radius)
+        self.center = np.asarray(center, dtype=np.float64)
+
+    def bounds(self):
+        return self.center - self.radius, self.center + self.radius
+
+    def distance(self, points):
+        return np.linalg.norm(points - self.center, axis=1) - self.radius
+
+
+class PointCloudShape:
+
+    # imported mesh approximated by a sphere around each of its vertices
+    # (see factory.readModelVertices), e.g. a rock
+
+    def __init__(self, points, radius):
+        self.points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+        self.radius = float(radius)
+
+    def bounds(self):
+        return self.points.min(axis=0) - self.radius, self.points.max(axis=0) + self.radius
+
+    def distance(self, points, chunk=4096):
+        distance = np.empty(len(points))
+        for start in range(0, len(points), chunk):
+            block = points[start:start + chunk]
+            d2 = ((block[:, None, :] - self.points[None, :, :]) ** 2).sum(axis=2)
+            distance[start:start + chunk] = np.sqrt(d2.min(axis=1)) - self.radius
+        return distance
+
+
+class DistanceField:
+
+    # Signed distance to the closest wall or obstacle sampled on a voxel grid,
+    # positive in the water. Built once, the distance and its gradient (the
+    # direction away from the closest wall) of any number of points are then
+    # read with a single trilinear interpolation, whatever the shapes.
+
+    def __init__(self, tank, obstacles=(), voxelSize=VOXEL_SIZE):
+        self.tank = tank
+        self.obstacles = list(obstacles)
+        self.voxelSize = float(voxelSize)
+
+        low, high = tank.bounds()
+        # a margin of voxels so that fish caught outside the tank still have a gradient
+        self.origin = low - 2 * self.voxelSize
+        self.dims = np.ceil((high + 2 * self.voxelSize - self.origin) / self.voxelSize).astype(np.int64) + 1
+        # half extents of the tank, used to scale the avoidance distance
+        self.halfExtents = (high - low) / 2
+
+        axes = [self.origin[i] + np.arange(self.dims[i]) * self.voxelSize for i in range(3)]
+        points = np.stack(np.meshgrid(*axes, indexing="ij"), axis=-1).reshape(-1, 3)
+        distance = -tank.distance(points)
+        for obstacle in self.obstacles:
+            distance = np.minimum(distance, obstacle.distance(points))
+        distance = distance.reshape(tuple(self.dims))
+        gradient = np.stack(np.gradient(distance, self.voxelSize), axis=-1)
+
+        # distance and gradient of each voxel, gathered together by sample
+        self.values = np.concatenate([distance[..., None], gradient], axis=-1).reshape(-1, 4)
+        print(f"distance field of {self.dims[0]}x{self.dims[1]}x{self.dims[2]} voxels "
+              f"({len(self.obstacles)} obstacles)")
+
+    def sample(self, points):
+        # (distance, unit gradient) of each point
+        u = (np.asarray(points, dtype=np.float64) - self.origin) / self.voxelSize
+        u = np.clip(u, 0, self.dims - 1 - 1e-6)
+        i0 = np.floor(u).astype(np.int64)
+        f = u - i0
+        strides = np.array([self.dims[1] * self.dims[2], self.dims[2], 1])
+        base = i0 @ strides
+
+        values = np.zeros((len(u), 4))
+        for corner in range(8):
+            offset = np.array([(corner >> 2) & 1, (corner >> 1) & 1, corner & 1])
+            weight = np.prod(np.where(offset, f, 1 - f), axis=1)
+            values += weight[:, None] * self.values[base + offset @ strides]
+
+        gradient = values[:, 1:]
+        gradient /= np.maximum(np.linalg.norm(gradient, axis=1), 1e-9)[:, None]
+        return values[:, 0], gradient
+
+
+class BoxBoundary:
+
+    # Keeps the fish in an axis aligned box, face by face (same behaviour as FishActor.stayInTank).
+    # The faces are handled with the HPR of the fish, converted from / to their directions.
+
+    def __init__(self, tankDimensions):
+        self.tank = np.asarray(tankDimensions, dtype=np.float64)
+
+    def stayInTank(self, engine, fishIdx, globalSpeed, dt):
+
+        tank = self.tank
+        pos = engine.pos[fishIdx]
+        hpr = directionsToHpr(engine.forward[fishIdx])
+        speed = globalSpeed[fishIdx]
+
+        ##########################################
+        # Catch fish before they exit the tank !
+        margin = CONFIG["catchMargin"]
+        escapeHpr = np.zeros_like(hpr)
+        escapeXYZ = np.zeros_like(pos)
+        for dim, sign in TANK_FACES:
+            distance = tank[dim] - sign * pos[:, dim]
+            hit = (distance < margin) & (sign * speed[:, dim] > 0)
+            if dim == 0:
+                escapeHpr[hit, 0] += 180 - 2 * hpr[hit, 0]
+            elif dim == 1:
+                escapeHpr[hit, 0] += -2 * hpr[hit, 0]
+            else:
+                escapeHpr[hit, 2] += -2 * hpr[hit, 2]
+            escapeXYZ[hit, dim] -= sign * margin
+
+        escaped = np.any(escapeHpr != 0, axis=1)
+        hpr[escaped] = normAngles(hpr[escaped] + escapeHpr[escaped])
+        pos[escaped] += escapeXYZ[escaped]
+        # FishActor.stayInTank stores [0,0] for the last face of its loop
+        engine.targetIncidence[fishIdx[escaped], 2, 1] = 0
+        engine.escapeTimeout[fishIdx[escaped]] = CONFIG["escapeTimeout"]
+
+        ##################################
+        # compute move to avoid the borders
+        steering = ~escaped
+        targets = engine.targetIncidence[fishIdx]
+        for dim, sign in TANK_FACES:
+            side = 0 if sign == 1 else 1
+            hpr[steering] = normAngles(hpr[steering])
+
+            distance = np.abs(sign * tank[dim] - pos[:, dim])
+            near = steering & (distance < tank[dim] * CONFIG["tankAvoid"])
+            target = targets[:, dim, side]
+            pending = np.isnan(target[:, 0])
+            # opposite direction so nothing to do
+            abort = pending & (sign * speed[:, dim] < 0)
+            move = near & ~abort
+
+            head, roll = hpr[:, 0], hpr[:, 2]
+            if dim == 0:
+                targetHead = 180 - 2 * head if sign == 1 else -180 - head
+                targetRoll = roll
+            elif dim == 1:
+                targetHead, targetRoll = -head, roll
+            else:
+                targetHead, targetRoll = head, -roll
+            init = move & pending
+            target[init, 0] = normAngles(targetHead[init])
+            target[init, 1] = normAngles(targetRoll[init])
+
+            # step size depends on remaining speed and distance
+            multiplier = np.maximum(5, 10 * engine.speed[fishIdx] / np.maximum(distance, 1e-6))
+            rotateHead = fastestPaths(target[:, 0], head) * dt * multiplier
+            rotateRoll = fastestPaths(target[:, 1], roll) * dt * multiplier
+            hpr[move, 0] += rotateHead[move]
+            hpr[move, 2] += rotateRoll[move]
+
+            # clear incidence
+            target[steering & ~near] = np.nan
+            targets[:, dim, side] = target
+
+        engine.targetIncidence[fishIdx] = targets
+        engine.forward[fishIdx] = hprToDirections(hpr)
+        engine.pos[fishIdx] = pos
+
+
+class FieldBoundary:
+
+    # Keeps the fish in the water of a DistanceField : any tank shape and
+    # static obstacles, all the fish are handled by one lookup in the field.
+    # Fish approaching a wall turn towards the reflection of their direction
+    # on the wall, fish about to cross it are reflected at once.
+
+    def __init__(self, field):
+        self.field = field
+
+    def stayInTank(self, engine, fishIdx, globalSpeed, dt):
+
+        pos = engine.pos[fishIdx]
+        forward = engine.forward[fishIdx]
+        distance, normal = self.field.sample(pos)
+
+        approach = np.einsum("ij,ij->i", forward, normal)
+        # direction mirrored by the closest wall
+        reflected = forward - 2 * np.minimum(approach, 0)[:, None] * normal
+        reflected = clampElevation(reflected, MAX_ELEVATION)
+
+        ##########################################
+        # Catch fish before they exit the water !
+        margin = CONFIG["catchMargin"]
+        escaped = (distance < margin) & (approach < 0)
+        forward[escaped] = reflected[escaped]
+        pos[escaped] += normal[escaped] * margin
+        engine.escapeTimeout[fishIdx[escaped]] = CONFIG["escapeTimeout"]
+
+        ##################################
+        # compute move to avoid the walls
+        # avoidance distance scaled like the box faces : a fraction of the tank size along the normal
+        avoidDistance = CONFIG["tankAvoid"] * np.abs(normal) @ self.field.halfExtents
+        target = engine.targetDirection[fishIdx]
+        near = ~escaped & (distance < avoidDistance)
+        pending = np.isnan(target[:, 0])
+        # opposite direction so nothing to do
+        move = near & ~(pending & (approach > 0))
+
+        init = move & pending
+        target[init] = reflected[init]
+
+        # step size depends on remaining speed and distance
+        multiplier = np.maximum(5, 10 * engine.speed[fishIdx] / np.maximum(distance, 1e-6))
+        engine.backend.turnTowards(forward, np.where(move[:, None], target, forward), move, dt * multiplier)
+
+        # clear incidence
+        target[escaped | ~near] = np.nan
+        engine.targetDirection[fishIdx] = target
+        engine.forward[fishIdx] = forward
+        engine.pos[fishIdx] = pos
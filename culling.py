@@ -0,0 +1,27 @@
+import numpy as np
+
+
+class FrustumCuller:
+
+    # Which fish the camera can see.
+    # A sphere around each fish is tested against the planes of the view
+    # frustum of the camera lens (perspective or orthographic), all the fish
+    # at once. The tank is a wireframe : it does not hide any fish.
+
+    def __init__(self, cam, root, radius):
+        # cam : camera NodePath (its lens may change, e.g. 2D render), root : scene root
+        self.cam = cam
+        self.root = root
+        self.radius = float(radius)
+
+    def frustumPlanes(self):
+        # (a, b, c, d) of each plane in the scene referential, pointing out of the frustum
+        bounds = self.cam.node().getLens().makeBounds()
+        bounds.xform(self.cam.getMat(self.root))
+        return np.array([tuple(bounds.getPlane(i)) for i in range(bounds.getNumPlanes())])
+
+    def visible(self, positions):
+        # mask of the fish at positions inside the frustum
+        planes = self.frustumPlanes()
+        distance = np.asarray(positions, dtype=np.float64) @ planes[:, :3].T + planes[:, 3]
+        return np.all(distance <= self.radius, axis=1)
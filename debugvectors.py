@@ -0,0 +1,76 @@
+from panda3d.core import Geom, GeomNode, GeomLines, GeomVertexData
+import numpy as np
+
+from factory import mkColoredVertexFormat
+from swarmcore import VECTOR_ALIGNER, VECTOR_ATTRACTOR, VECTOR_REPULSOR, VECTOR_SPEED
+
+# colors of the debug vectors
+VECTOR_COLORS = {
+    VECTOR_ALIGNER: (0, 1, 1, 1),
+    VECTOR_ATTRACTOR: (0, 1, 0, 1),
+    VECTOR_REPULSOR: (1, 0, 0, 1),
+    VECTOR_SPEED: (0, 0, 1, 1),
+}
+
+
+class DebugVectorLayer:
+
+    # All the debug vectors of the swarm in a single GeomNode.
+    # The vertex buffer is dynamic and rewritten in place every frame,
+    # so drawing vectors does not create or delete any node.
+
+    def __init__(self, parent, capacity=1024, thickness=2):
+
+        self.palette = np.zeros((max(VECTOR_COLORS) + 1, 4), dtype=np.float32)
+        for kind, color in VECTOR_COLORS.items():
+            self.palette[kind] = color
+
+        vdata = GeomVertexData("debug-vectors", mkColoredVertexFormat(), Geom.UHDynamic)
+        vdata.setNumRows(2 * capacity)
+        lines = GeomLines(Geom.UHDynamic)
+        geom = Geom(vdata)
+        geom.addPrimitive(lines)
+        node = GeomNode("debug-vectors")
+        node.addGeom(geom)
+        # the vectors move every frame : no need to compute bounds
+        node.setFinal(True)
+
+        self.node = parent.attachNewNode(node)
+        self.node.setRenderModeThickness(thickness)
+        self.node.setLightOff()
+        self.capacity = capacity
+        self.enabled = True
+
+    def isEnabled(self):
+        return self.enabled
+
+    def setEnabled(self, enabled):
+        self.enabled = enabled
+        if enabled:
+            self.node.show()
+        else:
+            self.node.hide()
+            self.clear()
+
+    def clear(self):
+        self.draw(np.zeros((0, 3)), np.zeros((0, 3)), np.zeros(0, dtype=np.int64))
+
+    def draw(self, starts, ends, kinds):
+        # starts/ends : (n,3) arrays in the parent referential, kinds : VECTOR_* of each vector
+        count = len(starts)
+        geom = self.node.node().modifyGeom(0)
+        vdata = geom.modifyVertexData()
+        if count > self.capacity:
+            self.capacity = max(count, 2 * self.capacity)
+            vdata.setNumRows(2 * self.capacity)
+
+        if count > 0:
+            rows = np.asarray(memoryview(vdata.modifyArray(0))).view(np.float32).reshape(-1, 7)
+            rows[0:2 * count:2, 0:3] = starts
+            rows[1:2 * count:2, 0:3] = ends
+            colors = self.palette[kinds]
+            rows[0:2 * count:2, 3:7] = colors
+            rows[1:2 * count:2, 3:7] = colors
+
+        lines = geom.modifyPrimitive(0)
+        lines.setNonindexedVertices(0, 2 * count)
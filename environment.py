@@ -0,0 +1,112 @@
+import numpy as np
+
+ENVIRONMENT_KINDS = ["attractors", "repulsors", "aligners"]
+
+# cube coordinates are packed in a single key, 21 bits per axis
+KEY_BITS = 21
+KEY_OFFSET = 1 << (KEY_BITS - 1)
+
+
+def packKeys(coords):
+    shifted = coords + KEY_OFFSET
+    return (shifted[..., 0] << (2 * KEY_BITS)) | (shifted[..., 1] << KEY_BITS) | shifted[..., 2]
+
+
+class EnvironmentIndex:
+
+    # Environment objects (food, predators, rocks, lights...) hashed in cubes.
+    # Unlike the fish grid the cubes are not bounded, objects may be anywhere.
+    # A range query only examines the objects of the cubes around each fish,
+    # found by a binary search in the objects sorted by cube. Moving an object
+    # only rewrites its row, the objects are sorted again (lazily) only when
+    # one of them changed of cube.
+
+    def __init__(self, cellSize):
+        self.cellSize = float(cellSize)
+        self.pos = np.zeros((0, 3))
+        self.hpr = np.zeros((0, 3))
+        # kind index in ENVIRONMENT_KINDS, -1 for a removed object
+        self.kinds = np.zeros(0, dtype=np.int64)
+        self.keys = np.zeros(0, dtype=np.int64)
+        self.free = []
+        # kind => (object ids sorted by cube, their keys)
+        self._sorted = {}
+        # object / fish pairs examined by the last query
+        self.examined = 0
+
+    def __len__(self):
+        return int(np.count_nonzero(self.kinds >= 0))
+
+    def count(self, kind):
+        return int(np.count_nonzero(self.kinds == ENVIRONMENT_KINDS.index(kind)))
+
+    def _key(self, pos):
+        return int(packKeys(np.floor_divide(np.asarray(pos, dtype=np.float64), self.cellSize).astype(np.int64)))
+
+    def add(self, kind, pos, hpr=(0, 0, 0)):
+        # returns the id of the new object
+        if self.free:
+            objectId = self.free.pop()
+        else:
+            objectId = len(self.kinds)
+            self.pos = np.concatenate([self.pos, np.zeros((1, 3))])
+            self.hpr = np.concatenate([self.hpr, np.zeros((1, 3))])
+            self.kinds = np.append(self.kinds, -1)
+            self.keys = np.append(self.keys, 0)
+        self.kinds[objectId] = ENVIRONMENT_KINDS.index(kind)
+        self.pos[objectId] = pos
+        self.hpr[objectId] = hpr
+        self.keys[objectId] = self._key(pos)
+        self._sorted = {}
+        return objectId
+
+    def remove(self, objectId):
+        self.kinds[objectId] = -1
+        self.free.append(objectId)
+        self._sorted = {}
+
+    def move(self, objectId, pos, hpr=None):
+        self.pos[objectId] = pos
+        if hpr is not None:
+            self.hpr[objectId] = hpr
+        key = self._key(pos)
+        if key != self.keys[objectId]:
+            self.keys[objectId] = key
+            self._sorted = {}
+
+    def _sortedObjects(self, kind):
+        if kind not in self._sorted:
+            ids = np.nonzero(self.kinds == ENVIRONMENT_KINDS.index(kind))[0]
+            ids = ids[np.argsort(self.keys[ids], kind="stable")]
+            self._sorted[kind] = (ids, self.keys[ids])
+        return self._sorted[kind]
+
+    def query(self, kind, positions, radius=None):
+        # (rows, ids) pairs : object ids of the kind within radius of positions[rows]
+        # every object of the kind for every position when radius is None
+        ids, keys = self._sortedObjects(kind)
+        n = len(positions)
+        if len(ids) == 0 or n == 0:
+            self.examined = 0
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+        if radius is None:
+            self.examined = n * len(ids)
+            return np.repeat(np.arange(n), len(ids)), np.tile(ids, n)
+
+        # cubes overlapping the sphere of radius around each position
+        span = int(np.ceil(radius / self.cellSize))
+        axis = np.arange(-span, span + 1)
+        offsets = np.stack(np.meshgrid(axis, axis, axis, indexing="ij"), axis=-1).reshape(-1, 3)
+        coords = np.floor_divide(np.asarray(positions, dtype=np.float64), self.cellSize).astype(np.int64)
+        cellKeys = packKeys(coords[:, None, :] + offsets[None, :, :]).ravel()
+
+        start = np.searchsorted(keys, cellKeys, side="left")
+        counts = np.searchsorted(keys, cellKeys, side="right") - start
+        rows = np.repeat(np.arange(n * len(offsets)) // len(offsets), counts)
+        within = np.arange(int(counts.sum())) - np.repeat(np.cumsum(counts) - counts, counts)
+        candidates = ids[np.repeat(start, counts) + within]
+        self.examined = len(candidates)
+
+        delta = self.pos[candidates] - positions[rows]
+        inRange = np.einsum("ij,ij->i", delta, delta) <= radius * radius
+        return rows[inRange], candidates[inRange]
@@ -2,24 +2,16 @@ from panda3d.core import LineSegs, NodePath
 import numpy as np
 from panda3d.core import AmbientLight, DirectionalLight, Vec3, Vec4
 from panda3d.core import Geom, GeomNode, GeomVertexFormat, GeomVertexData
-from panda3d.core import GeomVertexWriter, GeomTriangles, TransparencyAttrib
+from panda3d.core import GeomVertexWriter, GeomVertexReader, GeomTriangles, TransparencyAttrib
 from panda3d.core import NodePath
+from panda3d.core import GeomVertexArrayFormat, InternalName
 
 import math
 
+from swarmcore import computeGridDimentions
 
-def _computeCubeMapping(dimensions, segments=10):
 
-    min_width = min(int(dimensions.x), int(dimensions.y), int(dimensions.z))
-    cube_width = math.ceil(min_width/segments)
-    cube_width = max(cube_width, 100)
-    return [cube_width, 
-            math.ceil(2*dimensions.x/cube_width), 
-            math.ceil(2*dimensions.y/cube_width),
-            math.ceil(2*dimensions.z/cube_width)]
-
-
-def mkSpatialGrid(dimensions, min_segments=6 ):
+def mkSpatialGrid(dimensions, min_segments=6):
 
     # dimentions represent the half lenth for the X,Y,Z axis
     root = NodePath("3dGrid")
@@ -30,28 +22,21 @@ def mkSpatialGrid(dimensions, min_segments=6 ):
     # we have at least {segments} cubes for the smallest dimention.
     print(f"compute cubeSize with {min_segments} segments" )
 
-    cubeSize = _computeCubeMapping(dimensions, min_segments)
+    cubeSize = computeGridDimentions(dimensions, min_segments)
     print(f"cubeSize = {cubeSize}")
 
     print(f" total number of cubes = {cubeSize[1]*cubeSize[2]*cubeSize[3]}")
 
-    cubGrid = [[[None for _ in range(cubeSize[3])] for _ in range(cubeSize[2])] for _ in range(cubeSize[1])]
-
-    for x in range(0, len(cubGrid)):
-        for y in range(0, len(cubGrid[0])):
-            for z in range(0, len(cubGrid[0][0])):
+    # the cubes are displayed by a GridOverlay attached to root
+    return (root, cubeSize)
 
-                cubGrid[x][y][z] = mkCube(Vec3(cubeSize[0]/2, cubeSize[0]/2, cubeSize[0]/2), 1, [0.8,0.8,1, 0.1], wire_frame=False)
-                cub = cubGrid[x][y][z]
-                cub.reparentTo(root)
-                cub.setPos(x*cubeSize[0], y*cubeSize[0], z*cubeSize[0])
-                cub.hide()
 
-    dx = cubeSize[0]/2 - int((len(cubGrid) * cubeSize[0])/2) 
-    dy = cubeSize[0]/2 - int((len(cubGrid[0]) * cubeSize[0])/2)
-    dz = cubeSize[0]/2- int((len(cubGrid[0][0]) * cubeSize[0])/2)
-    root.setPos(dx,dy,dz)
-    return (root, cubGrid, cubeSize)
+def mkColoredVertexFormat():
+    # position + RGBA color, both float32 so that they can be written with numpy
+    array = GeomVertexArrayFormat()
+    array.addColumn(InternalName.getVertex(), 3, Geom.NTFloat32, Geom.CPoint)
+    array.addColumn(InternalName.getColor(), 4, Geom.NTFloat32, Geom.CColor)
+    return GeomVertexFormat.registerFormat(GeomVertexFormat(array))
 
 
 def mkCube(dimensions,thickness=2.0, col=[1,1,1,1],wire_frame=True):
@@ -155,3 +140,54 @@ def mkCubeWireframe(dimensions,thickness=2.0, col=[1,1,1]):
     
 
     return NodePath(line_node)
+
+
+def _drawCircle(lines, center, radius, axes, segments):
+    # circle in the plane of the 2 given axes (indices of X,Y,Z)
+    for i in range(segments + 1):
+        angle = 2 * math.pi * i / segments
+        point = list(center)
+        point[axes[0]] += radius * math.cos(angle)
+        point[axes[1]] += radius * math.sin(angle)
+        if i == 0:
+            lines.moveTo(*point)
+        else:
+            lines.drawTo(*point)
+
+
+def mkCylinderWireframe(radius, halfHeight, thickness=2.0, col=[1,1,1], segments=48):
+    # vertical cylinder : top and bottom circles and a few vertical edges
+    lines = LineSegs()
+    lines.setThickness(thickness)
+    lines.setColor(col[0], col[1], col[2])
+    for z in (-halfHeight, halfHeight):
+        _drawCircle(lines, (0, 0, z), radius, (0, 1), segments)
+    for i in range(8):
+        angle = 2 * math.pi * i / 8
+        x, y = radius * math.cos(angle), radius * math.sin(angle)
+        lines.moveTo(x, y, -halfHeight)
+        lines.drawTo(x, y, halfHeight)
+    return NodePath(lines.create())
+
+
+def mkSphereWireframe(radius, thickness=2.0, col=[1,1,1], segments=48):
+    # the 3 great circles of the sphere
+    lines = LineSegs()
+    lines.setThickness(thickness)
+    lines.setColor(col[0], col[1], col[2])
+    for axes in ((0, 1), (0, 2), (1, 2)):
+        _drawCircle(lines, (0, 0, 0), radius, axes, segments)
+    return NodePath(lines.create())
+
+
+def readModelVertices(model, relativeTo=None):
+    # positions of all the vertices of a model as a (n, 3) array,
+    # in the referential of relativeTo (the model itself by default)
+    vertices = []
+    for geomPath in model.findAllMatches("**/+GeomNode"):
+        transform = geomPath.getMat(relativeTo if relativeTo is not None else model)
+        for geom in geomPath.node().getGeoms():
+            reader = GeomVertexReader(geom.getVertexData(), "vertex")
+            while not reader.isAtEnd():
+                vertices.append(tuple(transform.xformPoint(reader.getData3())))
+    return np.array(vertices, dtype=np.float64).reshape(-1, 3)
@@ -12,32 +12,51 @@ import sys
 from panda3d.core import Point3, TransparencyAttrib,TextNode
 from direct.gui.DirectGui import DirectFrame, DirectButton, DGG, DirectCheckButton
 from panda3d.core import OrthographicLens,PerspectiveLens
-from basesimulation import BaseSimulation, BaseSimulationWithDrawer
+from swarmcore import CONFIG, INTERACTION_MAX_RADIUS, FISH_LENGTH
+from swarmcore import VECTOR_ALIGNER, VECTOR_ATTRACTOR, VECTOR_REPULSOR, VECTOR_SPEED, SPEED_VECTOR_RATIO
+from swarmcore import randomFishHpr, gridLayout, triangleLayout
 
 
-CONFIG = { 
-        "tankAvoid":0.3,
-        "fishCollisionRadius":10,
-        "fishAlignRadius":20,
-        "fishAttractdRadius":50,
-        "catchMargin": 10,
-        "cohesion" : 4,
-        "escapeTimeout" : 30,
-        "FOV": 110
-        }
-
-INTERACTION_MAX_RADIUS=800
+# play the model animation on each fish : this requires one Actor per fish
+ANIMATE_FISH=False
 
 def createFish( x, y, z, model, scalingRatio,  idx):
     fishActor = FishActor(model)
     fishActor.setPos(x, y, z)
-    fishActor.setHpr(random.uniform(-8,8), 0, random.uniform(-5,5))
+    fishActor.setHpr(*randomFishHpr())
     
     fishActor.name = f"fish_{idx}"
     fishActor.setScale(scalingRatio *  fishActor.length)
     return fishActor
 
-
+def createFishNode( x, y, z, model, scalingRatio, idx):
+    # lightweight fish : a plain node, the simulation state is kept outside
+    fishNode = NodePath(f"fish_{idx}")
+    attachFishModel(fishNode, model)
+    fishNode.setPos(x, y, z)
+    fishNode.setHpr(*randomFishHpr())
+    fishNode.setScale(scalingRatio * FISH_LENGTH)
+    return fishNode
+
+def resetFish(fish, x, y, z):
+    # a pooled fish back to the state of a new one at x, y, z
+    fish.setPos(x, y, z)
+    fish.setHpr(*randomFishHpr())
+    if isinstance(fish, FishActor):
+        fish.resetState()
+
+def attachFishModel(fishNode, model):
+    if model is None:
+        return
+    if ANIMATE_FISH:
+        actor = Actor(model)
+        actor.reparentTo(fishNode)
+        animNames = actor.getAnimNames()
+        if animNames:
+            actor.loop(animNames[0])
+    else:
+        # all the fish share the geometry of the loaded model
+        model.instanceTo(fishNode)
 
 def convertDirectionToHpr(adjustment):
     adj_XY = Vec3(adjustment[0], adjustment[1], 0)
@@ -62,21 +81,27 @@ def normAngle(angle):
 def normAngleVec(angleVec):
     return Vec3(normAngle(angleVec[0]), normAngle(angleVec[1]), normAngle(angleVec[2]))
 
-class FishActor(Actor):
+class FishActor(NodePath):
 
-    def __init__(self, model, **kwargs):
-        # Initialize the base class with the model and any other required arguments
-        super().__init__(model, **kwargs) #  ???
+    def __init__(self, model):
+        NodePath.__init__(self, "fish")
+        # only pays the Actor cost when the fish are animated
+        attachFishModel(self, model)
 
         # Set additional properties for FishActor
         self.model_name = "fish-ani"  # or derived from model parameter
-        self.length = 10  # Assuming a default length for all fish
-        
+        self.length = FISH_LENGTH
+
+        self._model = model
+        self.resetState()
+
+    def resetState(self):
+        # simulation state of a new fish (also used when a pooled fish is reused)
+
         # Initial speed
         forwardSpeed=25
         self.speedVec = Vec3(forwardSpeed, 0, 0)  # Initial speed vector
 
-        self._model = model
         self.targetIncidence = [ [None]*2 for i in range(3)]
         
         # the cube the Fish is currently located in
@@ -85,6 +110,9 @@ class FishActor(Actor):
         self.neighbours=[]
 
         self.escapeTimeout=0
+
+        # list of (kind, vector) when debug vectors are recorded
+        self.vectors=None
     
 
     def get3DGridCoords(self, gridDimentions):
@@ -108,20 +136,6 @@ class FishActor(Actor):
     def getNeighbours(self):
         return self.neighbours
 
-    def computeNeighBours(self, gridDimentions, gridMapping, radius = 2):
-        
-        cubeCoords = self.getCube()
-        neighbours = []
-        for x in range(max(0, cubeCoords[0]-radius), min(gridDimentions[1], cubeCoords[0]+radius)):
-            for y in range(max(0, cubeCoords[1]-radius), min(gridDimentions[2], cubeCoords[1]+radius)):
-                for z in range(max(0, cubeCoords[2]-radius), min(gridDimentions[3], cubeCoords[2]+radius)):
-                        key = (x,y,z)
-                        if key in gridMapping:
-                            for f in gridMapping[key]:
-                                neighbours.append(f)
-        
-        return neighbours
-
     def getTargetIncidence(self, dim, sign):
         y=0
         if sign==-1:
@@ -144,7 +158,10 @@ class FishActor(Actor):
     def _fastestPath(self, target, start):
         return min(target-start, target-start+2*180, target-start-2*180, key=abs)
 
-    def stayInTank(self, tankDimensions, rootNode, globalSpeedVec):
+    def stayInTank(self, tankDimensions, rootNode, globalSpeedVec, dt=None):
+
+        if dt is None:
+            dt = globalClock.getDt()
 
         # Get fish position
         fishPos = self.getPos()
@@ -249,7 +266,6 @@ class FishActor(Actor):
                 #  compute step size depending on remaining speed and distance*0.7
                 multiplier = max(5, 10* self.speedVec.length() / distance)
                 #print(f"multiplier = {multiplier}")
-                dt = globalClock.getDt() 
                 rotate_step_head = degrees_to_rotate_head * dt * multiplier
                 rotate_step_roll = degrees_to_rotate_roll * dt * multiplier
 
@@ -266,8 +282,11 @@ class FishActor(Actor):
                 self.storeTargetIncidence(dim,sign, None)
 
 
-    def computeInfluence(self, neighbours, environment):
+    def computeInfluence(self, neighbours, environment, dt=None):
         #print(f" fish {self.name} neighbours => {neighbours}")
+
+        if dt is None:
+            dt = globalClock.getDt()
         
         adjustment = Vec3(0,0,0)
         adjustHPR = Vec3(0,0,0)
@@ -296,8 +315,6 @@ class FishActor(Actor):
         #print(f"fish {self.name}=> neighbours:{len(neighbours)}; attractors={len(attractors)}; repulsors={len(repulsors)}; :aligners = {len(aligners)}")
         
         # Aligners
-        idx=0
-        self.deleteArrows("aligner_")
         for aligner in aligners:
             # compiute aligner position : to know if we need to take into account
             adjustmentG = aligner.getPos()-self.getPos()
@@ -305,19 +322,14 @@ class FishActor(Actor):
             # convert to HPR
             adjustmentHPR = convertDirectionToHpr(adjustment)
             adjustmentHPR = normAngleVec(adjustmentHPR)
-            arrow_name = f"aligner_{self.name}_{idx}"
             if abs(adjustmentHPR[0])>CONFIG["FOV"]:
-                self.deleteArrow(arrow_name)
                 continue
             # Align native HPR (not derived from displacement)
-            adjustHPR += (aligner.getHpr() - self.getHpr())*globalClock.getDt()                   
+            adjustHPR += (aligner.getHpr() - self.getHpr())*dt                   
             # display arrow
-            self.displayArrow(arrow_name, adjustment, 1, Vec3(0,1,1))
-            idx+=1
+            self.recordVector(VECTOR_ALIGNER, adjustmentG)
         
         # Attractors
-        idx=0
-        self.deleteArrows("attractor_")
         for attractor in attractors:
             # initial positions are in the global referential
             adjustmentG = attractor.getPos()-self.getPos()
@@ -327,20 +339,15 @@ class FishActor(Actor):
             adjustmentHPR = convertDirectionToHpr(adjustment)
             adjustmentHPR = normAngleVec(adjustmentHPR)
             #print(f"adjustmentHPR => {adjustmentHPR} Current HPR = {self.getHpr()}")
-            arrow_name = f"attractor_{self.name}_{idx}"
             # only attracted by what the fish can see: forward and not too far
             #if adjustment[0]<0 or adjustmentG.length()>INTERACTION_MAX_RADIUS:
             if abs(adjustmentHPR[0])>CONFIG["FOV"] or adjustmentG.length()>INTERACTION_MAX_RADIUS:
-                self.deleteArrow(arrow_name)
                 continue
             # display arrow
-            self.displayArrow(arrow_name, adjustment, 1, Vec3(0,1,0))
-            adjustHPR += adjustmentHPR*globalClock.getDt()
-            idx+=1
+            self.recordVector(VECTOR_ATTRACTOR, adjustmentG)
+            adjustHPR += adjustmentHPR*dt
 
         # Repulsors
-        idx=0
-        self.deleteArrows("repulsor_")
         for repulsor in repulsors:
             # initial positions are in the global referential
             adjustmentG = -(repulsor.getPos()-self.getPos())
@@ -349,17 +356,14 @@ class FishActor(Actor):
             # convert to HPR
             adjustmentHPR = convertDirectionToHpr(adjustment)
             adjustmentHPR = normAngleVec(adjustmentHPR)
-            arrow_name = f"repulsor_{self.name}_{idx}"
             # only attracted by what the fish can see: forward and not too far
             #if adjustment[0]>0 or adjustmentG.length()>INTERACTION_MAX_RADIUS:
             if (adjustmentHPR[0])>CONFIG["FOV"] or adjustmentG.length()>INTERACTION_MAX_RADIUS:
-                self.deleteArrow(arrow_name)
                 continue
             # display arrow
-            self.displayArrow(arrow_name, adjustment*-1, 1, Vec3(1,0,0))
+            self.recordVector(VECTOR_REPULSOR, adjustmentG*-1)
             #print(f"adjustmentHPR => {adjustmentHPR} Current HPR = {self.getHpr()}")
-            adjustHPR += adjustmentHPR*globalClock.getDt()
-            idx+=1
+            adjustHPR += adjustmentHPR*dt
 
         # Apply changes
         self.safeSetHpr(self.getHpr() + adjustHPR*CONFIG["cohesion"])
@@ -374,7 +378,14 @@ class FishActor(Actor):
         self.setHpr(hpr[0], hpr[1], roll)
 
 
-    def swim(self, rootNode, neighbours, tankDimensions, environment):
+    def swim(self, rootNode, neighbours, tankDimensions, environment, dt=None, influenceDt=None):
+        # neighbours None : no influence computed this step (simulation LOD)
+        # influenceDt : time covered by the influences (dt by default)
+
+        if dt is None:
+            dt = globalClock.getDt()
+        if influenceDt is None:
+            influenceDt = dt
     
         ############################################
         # Need to translate speed to the fish referencial
@@ -386,52 +397,29 @@ class FishActor(Actor):
 
         if self.escapeTimeout>0:
             # do not distruct trajectory when fish is escaping collision
-            self.escapeTimeout-=1
+            self.escapeTimeout-=dt
         else:
             ############################################
             # Compute influence from neighbours
-            self.computeInfluence(neighbours, environment) 
+            if neighbours is not None:
+                self.computeInfluence(neighbours, environment, influenceDt)
 
             ############################################
             # Collision avoidance
-            self.stayInTank(tankDimensions, rootNode, globalSpeedVec)
+            self.stayInTank(tankDimensions, rootNode, globalSpeedVec, dt)
+
+        self.recordVector(VECTOR_SPEED, globalSpeedVec*SPEED_VECTOR_RATIO)
 
         ############################################
         # Move with the resulting speed 
         # Scale the speed by the time delta for consistent movement over time
-        globalSpeedVec *= globalClock.getDt()
+        globalSpeedVec *= dt
         # Update the fish's position by the global speed vector
         self.setPos(self.getPos() + globalSpeedVec)
-        self.displayArrow("speed_arrow", self.speedVec, 0.3, Vec3(0,0,1))
 
 
-    def deleteArrows(self, arrow_node_name_prefix):
-        for npath in self.getChildren():
-            if  npath.name.startswith(arrow_node_name_prefix):
-                npath.remove_node()
-    
-    def deleteArrow(self, arrow_node_name):
-        # get child the hard way since find does not work
-        #arrow_node = self.find(f"render/{self.name}/{arrow_node_name}")
-        for npath in self.getChildren():
-            if  arrow_node_name in npath.name:
-                npath.remove_node()
-                break
-            
-    def displayArrow(self, arrow_node_name, vect, ratio, color):
-
-        self.deleteArrow(arrow_node_name)
-
-        # draw speed arrow
-        lines = LineSegs()
-        lines.setThickness(2)  
-        
-        lines.setColor(color)
-        
-        lines.moveTo(0, 0, 0)
-        lines.drawTo(vect.x * ratio, vect.y* ratio, vect.z* ratio)
-        line_node = lines.create()
-        
-        arrow_node = NodePath(line_node)
-        arrow_node.name = arrow_node_name
-        arrow_node.reparentTo(self)
+    def recordVector(self, kind, vect):
+        # debug vectors (global referential, relative to the fish)
+        # are collected for the swarm wide DebugVectorLayer
+        if self.vectors is not None:
+            self.vectors.append((kind, vect))
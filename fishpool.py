@@ -0,0 +1,52 @@
+from fish import resetFish
+
+
+class FishPool:
+
+    # Fish nodes kept from one swarm setup to the next.
+    # A new swarm reuses the pooled nodes, their state being reset in place,
+    # and only creates the nodes it is missing. The nodes a smaller swarm does
+    # not need are stashed (kept out of the scene) until a larger one does.
+    # Nodes are indexed by the slot of their fish (see SlotTable).
+
+    def __init__(self, parent, create):
+        # create(x, y, z, idx) => new fish node
+        self.parent = parent
+        self.create = create
+        self.nodes = []
+        self.activeCount = 0
+
+    def acquire(self, positions):
+        # the fish nodes of a swarm at positions
+        count = len(positions)
+        for idx, (x, y, z) in enumerate(positions):
+            if idx < len(self.nodes):
+                resetFish(self.nodes[idx], x, y, z)
+            else:
+                fish = self.create(x, y, z, idx)
+                fish.reparentTo(self.parent)
+                self.nodes.append(fish)
+        # including the slots of despawned fish
+        for fish in self.nodes[:count]:
+            fish.unstash()
+        for fish in self.nodes[count:self.activeCount]:
+            fish.stash()
+        self.activeCount = count
+        return self.nodes[:count]
+
+    def acquireSlot(self, slot, x, y, z):
+        # the node of a fish spawned in slot
+        if slot < len(self.nodes):
+            fish = self.nodes[slot]
+            resetFish(fish, x, y, z)
+            fish.unstash()
+        else:
+            fish = self.create(x, y, z, slot)
+            fish.reparentTo(self.parent)
+            self.nodes.append(fish)
+        self.activeCount = max(self.activeCount, slot + 1)
+        return fish
+
+    def releaseSlot(self, slot):
+        # the fish of slot was despawned
+        self.nodes[slot].stash()
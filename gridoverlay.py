@@ -0,0 +1,120 @@
+from panda3d.core import Geom, GeomNode, GeomTriangles, GeomVertexData, TransparencyAttrib
+from panda3d.core import GeomVertexArrayFormat, GeomVertexFormat, InternalName
+import numpy as np
+
+# same corners and faces as factory.mkCube3D
+CUBE_CORNERS = np.array([
+    [-1, -1, -1], [1, -1, -1], [1, 1, -1], [-1, 1, -1],
+    [-1, -1, 1], [1, -1, 1], [1, 1, 1], [-1, 1, 1],
+], dtype=np.float32)
+CUBE_FACES = [[2, 1, 0, 3], [4, 5, 6, 7], [1, 2, 6, 5], [3, 0, 4, 7], [0, 1, 5, 4], [2, 3, 7, 6]]
+CUBE_TRIANGLES = np.array([[f[0], f[1], f[2], f[0], f[2], f[3]] for f in CUBE_FACES], dtype=np.uint32).ravel()
+
+# color of an occupied cube
+OCCUPIED_COLOR = (0.8, 0.8, 1, 0.1)
+# heatmap : fish per cube for the hottest color
+HEATMAP_SATURATION = 10
+
+
+def mkOverlayFormat():
+    # static positions and 8 bits colors in separate arrays :
+    # a color update only copies the (small) color array
+    positions = GeomVertexArrayFormat()
+    positions.addColumn(InternalName.getVertex(), 3, Geom.NTFloat32, Geom.CPoint)
+    colors = GeomVertexArrayFormat()
+    colors.addColumn(InternalName.getColor(), 4, Geom.NTUint8, Geom.CColor)
+    vertexFormat = GeomVertexFormat()
+    vertexFormat.addArray(positions)
+    vertexFormat.addArray(colors)
+    return GeomVertexFormat.registerFormat(vertexFormat)
+
+
+class GridOverlay:
+
+    # The cubes of the spatial grid as a single mesh.
+    # Each cube has its own vertices so that its color is a per vertex
+    # attribute : showing / hiding a cube only rewrites the colors of that
+    # cube in place (empty cubes are fully transparent). The mesh is only
+    # built the first time the overlay is enabled.
+
+    def __init__(self, parent, gridDimentions, heatmap=False):
+        self.parent = parent
+        self.cellSize = gridDimentions[0]
+        self.dims = np.array(gridDimentions[1:4], dtype=np.int64)
+        self.cellCount = int(np.prod(self.dims))
+        self.heatmap = heatmap
+        self.enabled = False
+        self.node = None
+        # occupancy currently displayed
+        self.shown = np.zeros(self.cellCount, dtype=np.int64)
+
+    def isEnabled(self):
+        return self.enabled
+
+    def setEnabled(self, enabled):
+        self.enabled = enabled
+        if enabled and self.node is None:
+            self.build()
+        if self.node is not None:
+            if enabled:
+                self.node.show()
+            else:
+                self.node.hide()
+
+    def build(self):
+        cells = np.stack(np.unravel_index(np.arange(self.cellCount), self.dims), axis=1)
+        gridMin = -self.dims * self.cellSize / 2
+        centers = (gridMin + (cells + 0.5) * self.cellSize).astype(np.float32)
+
+        vdata = GeomVertexData("grid-overlay", mkOverlayFormat(), Geom.UHDynamic)
+        vdata.setNumRows(8 * self.cellCount)
+        positions = np.asarray(memoryview(vdata.modifyArray(0))).view(np.float32).reshape(self.cellCount, 8, 3)
+        positions[:] = centers[:, None, :] + CUBE_CORNERS[None, :, :] * (self.cellSize / 2)
+        np.asarray(memoryview(vdata.modifyArray(1)))[:] = 0
+
+        triangles = GeomTriangles(Geom.UHStatic)
+        triangles.setIndexType(Geom.NTUint32)
+        indices = triangles.modifyVertices()
+        indices.setNumRows(len(CUBE_TRIANGLES) * self.cellCount)
+        firstVertex = 8 * np.arange(self.cellCount, dtype=np.uint32)
+        np.asarray(memoryview(indices)).view(np.uint32)[:] = (firstVertex[:, None] + CUBE_TRIANGLES[None, :]).ravel()
+
+        geom = Geom(vdata)
+        geom.addPrimitive(triangles)
+        node = GeomNode("grid-overlay")
+        node.addGeom(geom)
+
+        self.node = self.parent.attachNewNode(node)
+        self.node.setTransparency(TransparencyAttrib.MAlpha)
+        # a single mesh can not be depth sorted cube by cube
+        self.node.setDepthWrite(False)
+        self.shown[:] = 0
+
+    def colors(self, occupancy):
+        # RGBA (0-1) of cubes holding occupancy fish
+        colors = np.zeros((len(occupancy), 4), dtype=np.float32)
+        occupied = occupancy > 0
+        if self.heatmap:
+            heat = np.minimum(occupancy / HEATMAP_SATURATION, 1.0)
+            colors[:, 0] = heat
+            colors[:, 2] = 1 - heat
+            colors[:, 3] = np.where(occupied, 0.05 + 0.35 * heat, 0)
+        else:
+            colors[occupied] = OCCUPIED_COLOR
+        return colors
+
+    def update(self, occupancy):
+        # occupancy : number of fish of each cube, only the cubes that changed are rewritten
+        if not self.enabled:
+            return
+        changed = occupancy != self.shown
+        if not self.heatmap:
+            # only the empty / occupied state is displayed
+            changed &= (occupancy > 0) != (self.shown > 0)
+        changed = np.nonzero(changed)[0]
+        self.shown[changed] = occupancy[changed]
+        if len(changed) == 0:
+            return
+        vdata = self.node.node().modifyGeom(0).modifyVertexData()
+        colors = np.asarray(memoryview(vdata.modifyArray(1))).view(np.uint8).reshape(self.cellCount, 8, 4)
+        colors[changed] = np.round(self.colors(occupancy[changed]) * 255).astype(np.uint8)[:, None, :]
@@ -0,0 +1,149 @@
+from panda3d.core import Shader, Texture, GeomEnums, OmniBoundingVolume
+import numpy as np
+
+from swarmmath import hprToMatrices
+
+# each instance is a 3x4 affine transform stored in 3 RGBA32F texels
+INSTANCE_VERTEX_SHADER = """
+#version 140
+
+uniform mat4 p3d_ModelViewProjectionMatrix;
+uniform samplerBuffer instanceData;
+
+in vec4 p3d_Vertex;
+in vec3 p3d_Normal;
+in vec2 p3d_MultiTexCoord0;
+
+out vec2 texcoord;
+out vec3 normal;
+
+void main() {
+    int base = gl_InstanceID * 3;
+    vec4 row0 = texelFetch(instanceData, base);
+    vec4 row1 = texelFetch(instanceData, base + 1);
+    vec4 row2 = texelFetch(instanceData, base + 2);
+    vec3 world = vec3(dot(row0, p3d_Vertex), dot(row1, p3d_Vertex), dot(row2, p3d_Vertex));
+    gl_Position = p3d_ModelViewProjectionMatrix * vec4(world, 1.0);
+    normal = vec3(dot(row0.xyz, p3d_Normal), dot(row1.xyz, p3d_Normal), dot(row2.xyz, p3d_Normal));
+    texcoord = p3d_MultiTexCoord0;
+}
+"""
+
+# same lighting as BaseSimulation.setupLights
+INSTANCE_FRAGMENT_SHADER = """
+#version 140
+
+uniform sampler2D p3d_Texture0;
+uniform vec4 p3d_ColorScale;
+
+in vec2 texcoord;
+in vec3 normal;
+
+out vec4 p3d_FragColor;
+
+const vec3 lightDirection = normalize(vec3(0, -45, -45));
+
+void main() {
+    vec4 color = texture(p3d_Texture0, texcoord) * p3d_ColorScale;
+    float diffuse = max(dot(normalize(normal), -lightDirection), 0.0);
+    p3d_FragColor = vec4(color.rgb * (0.2 + 0.8 * diffuse), color.a);
+}
+"""
+
+
+def supportsHardwareInstancing(win):
+    if win is None:
+        return False
+    gsg = win.getGsg()
+    return (gsg.getSupportsBasicShaders() and gsg.getSupportsGeometryInstancing()
+            and gsg.getSupportsBufferTexture())
+
+
+class InstancedSwarmRenderer:
+
+    # Draws the whole swarm with a single copy of the fish model.
+    # With hardware instancing the model is drawn once per frame with one
+    # instance per fish, the transforms being uploaded from the swarm state
+    # as a single buffer texture. Pipes without shader support (e.g. the
+    # tinydisplay software renderer) fall back to one instance node per fish
+    # sharing the same geometry.
+    # The buffer and the nodes are allocated for every fish slot (capacity)
+    # and only grow : the fish hidden by the culling or despawned are left
+    # out of the instances drawn (hardware) or have their node stashed.
+
+    def __init__(self, parent, model, count, hardware=True):
+
+        self.root = parent.attachNewNode("swarm_instances")
+        self.hardware = hardware
+        self.capacity = 0
+        # number of fish drawn
+        self.count = 0
+
+        self.model = model.copyTo(self.root)
+        self.model.clearTransform()
+        self.model.flattenStrong()
+
+        if hardware:
+            # bounds of a single fish do not represent the swarm
+            self.root.node().setBounds(OmniBoundingVolume())
+            self.root.node().setFinal(True)
+            self.buffer = Texture("swarm_instances")
+            self.root.setShader(Shader.make(Shader.SL_GLSL, INSTANCE_VERTEX_SHADER, INSTANCE_FRAGMENT_SHADER))
+            self.root.setInstanceCount(0)
+        else:
+            self.model.detachNode()
+            self.nodes = []
+            # fish whose node is unstashed
+            self.shown = np.zeros(0, dtype=bool)
+
+        self.reserve(count)
+
+    def reserve(self, capacity):
+        # room for capacity fish (slots)
+        if capacity <= self.capacity:
+            return
+        if self.hardware:
+            # the rows drawn are all written again by the next update
+            self.buffer.setupBufferTexture(capacity * 3, Texture.T_float, Texture.F_rgba32, GeomEnums.UH_dynamic)
+            self.root.setShaderInput("instanceData", self.buffer)
+        else:
+            while len(self.nodes) < capacity:
+                node = self.root.attachNewNode(f"fish_{len(self.nodes)}")
+                self.model.instanceTo(node)
+                node.stash()
+                self.nodes.append(node)
+            self.shown = np.concatenate([self.shown, np.zeros(capacity - len(self.shown), dtype=bool)])
+        self.capacity = capacity
+
+    def update(self, pos, hpr, scale, shown=None):
+        # pos/hpr : (n,3) arrays, scale : (n,) array of every fish slot
+        # shown : mask of the fish to draw (all of them by default)
+        if shown is None:
+            shown = np.ones(len(pos), dtype=bool)
+        self.reserve(len(pos))
+        shownIdx = np.nonzero(shown)[0]
+
+        if not self.hardware:
+            for idx in np.nonzero(shown & ~self.shown[:len(shown)])[0].tolist():
+                self.nodes[idx].unstash()
+            for idx in np.nonzero(self.shown[:len(shown)] & ~shown)[0].tolist():
+                self.nodes[idx].stash()
+            self.shown[:len(shown)] = shown
+            for idx, p, h, s in zip(shownIdx.tolist(), pos[shownIdx].tolist(), hpr[shownIdx].tolist(), scale[shownIdx].tolist()):
+                self.nodes[idx].setPosHprScale(p[0], p[1], p[2], h[0], h[1], h[2], s, s, s)
+            self.count = len(shownIdx)
+            return
+
+        if len(shownIdx) != self.count:
+            self.count = len(shownIdx)
+            self.root.setInstanceCount(self.count)
+        if self.count == 0:
+            return
+        # column vector form of the Panda3D row vector transform
+        rot = hprToMatrices(hpr[shownIdx]) * scale[shownIdx, None, None]
+        rows = np.asarray(memoryview(self.buffer.modifyRamImage())).view(np.float32).reshape(-1, 3, 4)
+        rows[:self.count, :, 0:3] = rot.transpose(0, 2, 1)
+        rows[:self.count, :, 3] = pos[shownIdx]
+
+    def destroy(self):
+        self.root.removeNode()
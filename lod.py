@@ -0,0 +1,35 @@
+import numpy as np
+
+
+class SimulationLod:
+
+    # Distance based level of detail of the simulation.
+    # The fish closer than nearDistance to the viewpoint (the camera) compute
+    # their neighbours and influences every step. The others are split in
+    # `period` round robin batches (by slot id) : each step only one batch
+    # computes them, for the time elapsed since its last update (period
+    # steps), the other far fish keep swimming along their direction.
+
+    def __init__(self, nearDistance, period):
+        self.nearDistance = float(nearDistance)
+        self.period = max(1, int(period))
+        # None : every fish is near
+        self.viewpoint = None
+        self.frame = 0
+        # statistics of the last step
+        self.nearCount = 0
+        self.batchCount = 0
+
+    def select(self, pos, fishIdx):
+        # (near fish, far fish of the batch of this step) among fishIdx
+        batch = self.frame % self.period
+        self.frame += 1
+        if self.viewpoint is None or self.period == 1:
+            near, far = fishIdx, fishIdx[:0]
+        else:
+            delta = pos[fishIdx] - np.asarray(self.viewpoint, dtype=np.float64)
+            isNear = np.einsum("ij,ij->i", delta, delta) < self.nearDistance ** 2
+            far = fishIdx[~isNear]
+            near, far = fishIdx[isNear], far[far % self.period == batch]
+        self.nearCount, self.batchCount = len(near), len(far)
+        return near, far
@@ -0,0 +1,89 @@
+import hashlib
+import json
+import os
+
+from panda3d.core import Filename, LoaderOptions, NodePath, getModelPath
+
+# formats converted once to a .bam file of the cache (Panda3D does not cache them itself)
+CONVERTED_FORMATS = (".gltf", ".glb")
+
+
+def modelFiles(path):
+    # files defining the model at path : a .gltf and the buffers / images it references
+    files = [path]
+    if path.lower().endswith(".gltf"):
+        with open(path) as f:
+            scene = json.load(f)
+        folder = os.path.dirname(path)
+        for entry in scene.get("buffers", []) + scene.get("images", []):
+            uri = entry.get("uri")
+            if uri and not uri.startswith("data:"):
+                files.append(os.path.join(folder, uri))
+    return files
+
+
+def hashFiles(paths):
+    digest = hashlib.sha1()
+    for path in paths:
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                digest.update(f.read())
+    return digest.hexdigest()[:16]
+
+
+class ModelCache:
+
+    # Models loaded on first use.
+    # A model can be requested ahead of its use : the loader thread of Panda3D
+    # then loads it in the background and getting it only waits for the end
+    # of the load. The glTF models are converted once to a .bam file of the
+    # cache directory, named after the hash of their files : the .bam is
+    # loaded instead as long as these files do not change.
+
+    def __init__(self, loader, cacheDir):
+        # loader : panda3d.core.Loader
+        self.loader = loader
+        self.cacheDir = cacheDir
+        # path => NodePath
+        self.models = {}
+        # path => (load request, .bam file to write or None)
+        self.pending = {}
+
+    def source(self, path):
+        # (file to load, .bam file to write once loaded or None)
+        filename = Filename(path)
+        if "." + filename.getExtension().lower() not in CONVERTED_FORMATS:
+            # the loader searches the model path (and uses its own cache)
+            return filename, None
+        if not filename.resolveFilename(getModelPath().getValue()):
+            raise IOError(f"Model {path} not found on the model path")
+        osPath = filename.toOsSpecific()
+        bamPath = os.path.join(self.cacheDir, f"{filename.getBasenameWoExtension()}-{hashFiles(modelFiles(osPath))}.bam")
+        if os.path.exists(bamPath):
+            return Filename.fromOsSpecific(bamPath), None
+        return filename, bamPath
+
+    def request(self, path):
+        # start loading path in the background
+        if path in self.models or path in self.pending:
+            return
+        filename, bamPath = self.source(path)
+        request = self.loader.makeAsyncRequest(filename, LoaderOptions())
+        self.loader.loadAsync(request)
+        self.pending[path] = (request, bamPath)
+
+    def get(self, path):
+        # model of path, waits for its load if needed
+        if path not in self.models:
+            self.request(path)
+            request, bamPath = self.pending.pop(path)
+            node = request.result()
+            if node is None:
+                raise IOError(f"Could not load model {path}")
+            model = NodePath(node)
+            if bamPath is not None:
+                os.makedirs(self.cacheDir, exist_ok=True)
+                if model.writeBamFile(Filename.fromOsSpecific(bamPath)):
+                    print(f"Model {path} converted to {bamPath}")
+            self.models[path] = model
+        return self.models[path]
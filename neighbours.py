@@ -0,0 +1,232 @@
+import numpy as np
+
+
+def ringOffsets(r):
+    # offsets of the cubes at chebyshev distance r of a cube
+    span = np.arange(-r, r + 1)
+    offsets = np.stack(np.meshgrid(span, span, span, indexing="ij"), axis=-1).reshape(-1, 3)
+    return offsets[np.abs(offsets).max(axis=1) == r]
+
+
+def gatherCandidates(coords, offsets, dims, order, cellStart, occupancy):
+    # fish located in the cubes coords+offsets, one -1 padded row per query
+    cells = coords[:, None, :] + offsets[None, :, :]
+    valid = np.all((cells >= 0) & (cells < dims), axis=2)
+    rows, cols = np.nonzero(valid)
+    cellIds = np.ravel_multi_index(cells[rows, cols].T, dims)
+    counts = occupancy[cellIds]
+    filled = counts > 0
+    rows, cellIds, counts = rows[filled], cellIds[filled], counts[filled]
+
+    total = int(counts.sum())
+    within = np.arange(total) - np.repeat(np.cumsum(counts) - counts, counts)
+    members = order[np.repeat(cellStart[cellIds], counts) + within]
+
+    # rows are sorted, so the column is the rank of the candidate in its row
+    rows = np.repeat(rows, counts)
+    rowCount = np.bincount(rows, minlength=len(coords))
+    columns = np.arange(total) - np.repeat(np.cumsum(rowCount) - rowCount, rowCount)
+    candidates = np.full((len(coords), max(int(rowCount.max(initial=0)), 1)), -1, dtype=np.int64)
+    candidates[rows, columns] = members
+    return candidates
+
+
+def mergeNearest(bestDist, bestIdx, candDist, candIdx, k):
+    # keep the k closest of the current best and the new candidates (partial selection)
+    dist = np.concatenate([bestDist, candDist], axis=1)
+    idx = np.concatenate([bestIdx, candIdx], axis=1)
+    sel = np.argpartition(dist, k - 1, axis=1)[:, :k]
+    return np.take_along_axis(dist, sel, axis=1), np.take_along_axis(idx, sel, axis=1)
+
+
+class NeighbourQuery:
+
+    # k nearest neighbours lookup on top of a SpatialHash.
+    # The search starts with the cube of the fish and grows shell by shell
+    # only until the k-th neighbour found is closer than anything that could
+    # be in the unexplored cubes, or until maxRadius is covered.
+
+    def __init__(self, spatialHash):
+        self.grid = spatialHash
+        # the whole grid is covered after this many shells
+        self.maxShell = int(spatialHash.dims.max())
+        self._rings = {}
+        # number of fish examined by the last query
+        self.examined = 0
+
+    def getRing(self, r):
+        if r not in self._rings:
+            self._rings[r] = ringOffsets(r)
+        return self._rings[r]
+
+    def _innerDistance(self, positions, coords):
+        # distance from each position to the faces of its own cube
+        low = positions - (self.grid.gridMin + coords * self.grid.cellSize)
+        high = self.grid.cellSize - low
+        return np.minimum(low.min(axis=1), high.min(axis=1))
+
+    def kNearestBatch(self, positions, fishIdx, k, maxRadius, chunkSize=1024):
+        # k nearest fish of each fish of fishIdx : -1 padded (len(fishIdx), k) table
+        table = np.full((len(fishIdx), k), -1, dtype=np.int64)
+        self.examined = 0
+        for first in range(0, len(fishIdx), chunkSize):
+            table[first:first + chunkSize] = self._kNearestChunk(
+                positions, fishIdx[first:first + chunkSize], k, maxRadius)
+        return table
+
+    def _kNearestChunk(self, positions, fishIdx, k, maxRadius):
+
+        order, cellStart, occupancy = self.grid.csr()
+        coords = self.grid.fishCoords[fishIdx]
+        queryPos = positions[fishIdx]
+        inner = self._innerDistance(queryPos, coords)
+        maxDist2 = maxRadius * maxRadius
+
+        bestDist = np.full((len(fishIdx), k), np.inf)
+        bestIdx = np.full((len(fishIdx), k), -1, dtype=np.int64)
+
+        active = np.arange(len(fishIdx))
+        for r in range(self.maxShell + 1):
+            if len(active) == 0:
+                break
+            candidates = gatherCandidates(coords[active], self.getRing(r), self.grid.dims,
+                                          order, cellStart, occupancy)
+            valid = (candidates >= 0) & (candidates != fishIdx[active][:, None])
+            self.examined += int(valid.sum())
+            delta = positions[candidates] - queryPos[active][:, None, :]
+            dist = np.einsum("nmi,nmi->nm", delta, delta)
+            dist = np.where(valid & (dist <= maxDist2), dist, np.inf)
+            bestDist[active], bestIdx[active] = mergeNearest(
+                bestDist[active], bestIdx[active], dist, candidates, k)
+
+            # unexplored cubes are all further than reach
+            reach = inner[active] + r * self.grid.cellSize
+            done = (reach >= maxRadius) | (bestDist[active, k - 1] <= reach * reach)
+            active = active[~done]
+
+        return np.where(np.isinf(bestDist), -1, bestIdx)
+
+
+class VerletNeighbourList:
+
+    # Neighbour lists kept from one step to the next (Verlet lists).
+    # A build stores, for every fish of the grid, its k+extra nearest fish
+    # within maxRadius + skin. They are built again only when a fish has moved
+    # more than half the skin since the build, in between the k nearest of a
+    # fish are picked from its list. A list holds every fish up to its
+    # complete radius (its farthest entry, or maxRadius + skin when it is not
+    # full), so the pick is exact as long as the k-th neighbour is closer than
+    # that radius minus the moves since the build : the few fish for which it
+    # is not are looked up in the grid. Fish that left the grid since the
+    # build (despawned, out of a shard...) are skipped, the few that entered
+    # it are examined by every fish.
+
+    def __init__(self, query, extra, maxAdded=64):
+        self.query = query
+        self.extra = extra
+        # more fish entering the grid than this since the build : built again
+        self.maxAdded = maxAdded
+        # [fish] => nearest fish at the last build, -1 padded
+        self.lists = None
+        # [fish] => distance up to which the list of the fish is complete
+        self.complete = None
+        self.builtPos = None
+        self.builtMembers = None
+        self.builtKey = None
+        # statistics : builds, steps, fish served from / missed by the lists
+        self.builds = 0
+        self.steps = 0
+        self.hits = 0
+        self.misses = 0
+        # distances computed by the last query
+        self.examined = 0
+        self.rebuilt = False
+
+    def hitRate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+    def _build(self, positions, members, k, maxRadius, skin):
+        size = k + self.extra
+        radius = maxRadius + skin
+        count = len(members)
+        self.lists = np.full((count, size), -1, dtype=np.int64)
+        self.complete = np.full(count, -np.inf)
+        fishIdx = np.nonzero(members)[0]
+        if len(fishIdx) > 0:
+            table = self.query.kNearestBatch(positions, fishIdx, size, radius)
+            delta = positions[np.maximum(table, 0)] - positions[fishIdx][:, None, :]
+            dist = np.where(table >= 0, np.sqrt(np.einsum("nmi,nmi->nm", delta, delta)), -np.inf)
+            full = np.all(table >= 0, axis=1)
+            self.lists[fishIdx] = table
+            self.complete[fishIdx] = np.where(full, dist.max(axis=1), radius)
+            self.examined += self.query.examined
+        self.builtPos = positions.copy()
+        self.builtMembers = members.copy()
+        self.builtKey = (k, maxRadius, skin)
+        self.builds += 1
+
+    def kNearestBatch(self, positions, fishIdx, k, maxRadius, skin):
+        # same result as NeighbourQuery.kNearestBatch, the grid being up to date
+        positions = np.asarray(positions, dtype=np.float64)
+        members = self.query.grid.fishCells >= 0
+        self.steps += 1
+        self.examined = 0
+
+        # fish in the grid at the last build (the swarm may have grown since)
+        built = np.zeros(len(members), dtype=bool)
+        builtPos = np.zeros_like(positions)
+        if self.builtMembers is not None:
+            common = min(len(members), len(self.builtMembers))
+            built[:common] = self.builtMembers[:common]
+            builtPos[:common] = self.builtPos[:common]
+        added = np.nonzero(members & ~built)[0]
+        kept = members & built
+        moved = 0.0
+        if np.any(kept):
+            delta = positions[kept] - builtPos[kept]
+            moved = float(np.sqrt(np.einsum("ij,ij->i", delta, delta).max()))
+        self.rebuilt = (self.builtMembers is None or self.builtKey != (k, maxRadius, skin)
+                        or len(added) > self.maxAdded or moved > skin / 2)
+        if self.rebuilt:
+            self._build(positions, members, k, maxRadius, skin)
+            added = added[:0]
+            kept = members
+            moved = 0.0
+
+        # k nearest within maxRadius among the fish of the lists and the fish added since the build
+        count = len(self.lists)
+        lists = np.full((len(fishIdx), self.lists.shape[1]), -1, dtype=np.int64)
+        known = fishIdx < count
+        lists[known] = self.lists[fishIdx[known]]
+        candidates = np.concatenate([lists, np.broadcast_to(added, (len(fishIdx), len(added)))], axis=1)
+        valid = (candidates >= 0) & members[np.maximum(candidates, 0)] & (candidates != fishIdx[:, None])
+        self.examined += int(valid.sum())
+        delta = positions[np.maximum(candidates, 0)] - positions[fishIdx][:, None, :]
+        dist = np.einsum("nmi,nmi->nm", delta, delta)
+        dist = np.where(valid & (dist <= maxRadius * maxRadius), dist, np.inf)
+        bestDist, table = mergeNearest(np.full((len(fishIdx), k), np.inf),
+                                       np.full((len(fishIdx), k), -1, dtype=np.int64), dist, candidates, k)
+        table = np.where(np.isinf(bestDist), -1, table)
+
+        # a fish further than the complete radius of a list came closer by at most the
+        # difference of their moves since the build : bounded by the farthest corner of
+        # the box of all the moves (tight when the school swims together)
+        kth = np.sqrt(np.minimum(bestDist.max(axis=1, initial=0), maxRadius * maxRadius))
+        closer = np.full(len(fishIdx), 2 * moved)
+        if moved > 0:
+            moves = np.zeros_like(positions)
+            moves[kept] = positions[kept] - builtPos[kept]
+            low, high = moves[kept].min(axis=0), moves[kept].max(axis=0)
+            own = moves[fishIdx]
+            farthest = np.maximum(np.abs(own - low), np.abs(high - own))
+            closer = np.minimum(closer, np.sqrt(np.einsum("ij,ij->i", farthest, farthest)))
+        complete = np.full(len(fishIdx), -np.inf)
+        complete[known] = self.complete[fishIdx[known]]
+        missed = np.nonzero(~kept[fishIdx] | (kth >= complete - closer))[0]
+        if len(missed) > 0:
+            table[missed] = self.query.kNearestBatch(positions, fishIdx[missed], k, maxRadius)
+            self.examined += self.query.examined
+        self.misses += len(missed)
+        self.hits += len(fishIdx) - len(missed)
+        return table
@@ -0,0 +1,192 @@
+import csv
+import json
+import sys
+import time
+from collections import deque
+from contextlib import contextmanager
+
+
+def _pstatCollector(name):
+    # PStats collector when the application runs Panda3D : the profiler is
+    # also used without it (worker processes, swarmmodel) and does not import it
+    core = sys.modules.get("panda3d.core")
+    if core is None:
+        return None
+    return core.PStatCollector(f"Swarm:{name}")
+
+
+class PhaseProfiler:
+
+    # Times the phases of the simulation and records counters, frame by frame.
+    # Phases run several times in a frame (e.g. one per simulation step) are
+    # summed. The last frames are kept as rolling windows for the on-screen
+    # stats, each phase/counter is also a PStats collector and every frame can
+    # be recorded in a trace exported as CSV or JSON.
+
+    def __init__(self, window=120, enabled=True):
+        self.window = window
+        self.enabled = enabled
+        # name => per frame values (seconds for the phases)
+        self.timings = {}
+        self.counts = {}
+        # values of the frame in progress
+        self.frameTimings = {}
+        self.frameCounts = {}
+        # names of the counters set with setLevel
+        self.levels = set()
+        self.frameIndex = 0
+        self.collectors = {}
+        # list of per frame records when tracing
+        self.trace = None
+
+    def _getCollector(self, name):
+        if name not in self.collectors:
+            self.collectors[name] = _pstatCollector(name)
+        return self.collectors[name]
+
+    @contextmanager
+    def phase(self, name):
+        if not self.enabled:
+            yield
+            return
+        collector = self._getCollector(name)
+        if collector is not None:
+            collector.start()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.frameTimings[name] = self.frameTimings.get(name, 0.0) + time.perf_counter() - start
+            if collector is not None:
+                collector.stop()
+
+    def count(self, name, value):
+        # counter summed over the frame
+        if self.enabled:
+            self.frameCounts[name] = self.frameCounts.get(name, 0) + value
+
+    def setLevel(self, name, value):
+        # counter holding the last value of the frame
+        if self.enabled:
+            self.frameCounts[name] = value
+            self.levels.add(name)
+
+    def endFrame(self):
+        if not self.enabled:
+            return
+        for values, frame in ((self.timings, self.frameTimings), (self.counts, self.frameCounts)):
+            for name in frame:
+                if name not in values:
+                    values[name] = deque(maxlen=self.window)
+            for name, window in values.items():
+                if name in frame:
+                    window.append(frame[name])
+                elif name not in self.levels:
+                    # a level not set in this frame keeps out of the window
+                    window.append(0)
+
+        for name, value in self.frameCounts.items():
+            collector = self._getCollector(name)
+            if collector is not None:
+                collector.setLevel(value)
+
+        if self.trace is not None:
+            record = {"frame": self.frameIndex}
+            record.update({f"{name}_ms": seconds * 1000 for name, seconds in self.frameTimings.items()})
+            record.update(self.frameCounts)
+            self.trace.append(record)
+
+        self.frameTimings = {}
+        self.frameCounts = {}
+        self.frameIndex += 1
+
+    def stats(self):
+        # name => (mean, max) over the window, phases in milliseconds
+        stats = {}
+        for name, window in self.timings.items():
+            stats[name] = (1000 * sum(window) / len(window), 1000 * max(window))
+        for name, window in self.counts.items():
+            stats[name] = (sum(window) / len(window), max(window))
+        return stats
+
+    def formatStats(self):
+        lines = []
+        stats = self.stats()
+        for name in self.timings:
+            lines.append(f"{name:<20} {stats[name][0]:7.2f} ms (max {stats[name][1]:7.2f})")
+        for name in self.counts:
+            lines.append(f"{name:<20} {stats[name][0]:9.1f} (max {stats[name][1]:g})")
+        return "\n".join(lines)
+
+    def reset(self):
+        self.timings = {}
+        self.counts = {}
+        self.frameTimings = {}
+        self.frameCounts = {}
+
+    def isTracing(self):
+        return self.trace is not None
+
+    def startTrace(self):
+        self.trace = []
+
+    def stopTrace(self, path=None):
+        # stop recording, the trace is written to path (.csv or .json) if given
+        trace = self.trace
+        self.trace = None
+        if path is not None and trace is not None:
+            self.dumpTrace(path, trace)
+        return trace
+
+    def dumpTrace(self, path, trace=None):
+        trace = self.trace if trace is None else trace
+        if path.endswith(".csv"):
+            columns = ["frame"]
+            for record in trace:
+                columns.extend(key for key in record if key not in columns)
+            with open(path, "w", newline="") as f:
+                writer = csv.DictWriter(f, fieldnames=columns, restval=0)
+                writer.writeheader()
+                writer.writerows(trace)
+        else:
+            with open(path, "w") as f:
+                json.dump(trace, f, indent=1)
+        print(f"Profiler trace of {len(trace)} frames written to {path}")
+
+
+class StartupTimer:
+
+    # Durations of the startup phases (window, models, tank, swarm...) up to
+    # the first frame, printed once as a report.
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        # (name, seconds) in the order of the startup
+        self.phases = []
+        self.total = None
+
+    @contextmanager
+    def phase(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases.append((name, time.perf_counter() - start))
+
+    def isFinished(self):
+        return self.total is not None
+
+    def finish(self):
+        # end of the startup : prints the report once
+        if self.total is None:
+            self.total = time.perf_counter() - self.start
+            print(self.formatReport())
+
+    def formatReport(self):
+        total = self.total if self.total is not None else time.perf_counter() - self.start
+        lines = [f"Startup in {total:.2f} s"]
+        for name, seconds in self.phases:
+            lines.append(f"  {name:<20} {seconds:7.3f} s")
+        other = total - sum(seconds for _, seconds in self.phases)
+        lines.append(f"  {'other':<20} {other:7.3f} s")
+        return "\n".join(lines)
@@ -0,0 +1,47 @@
+class FixedStepScheduler:
+
+    # Advances the simulation with a fixed time step, independently of the
+    # render frame rate: a frame runs as many steps as needed to catch up
+    # with the elapsed time (at most maxSubsteps, the remaining time is then
+    # dropped so that a slow frame can not snowball). alpha is the fraction
+    # of a step left in the accumulator, used to interpolate the rendering
+    # between the last two simulation states.
+
+    def __init__(self, rate=60.0, maxSubsteps=4):
+        self.setRate(rate)
+        self.maxSubsteps = maxSubsteps
+        self.accumulator = 0.0
+        self.alpha = 1.0
+        # statistics
+        self.steps = 0
+        # time dropped by the last advance and in total
+        self.dropped = 0.0
+        self.droppedTime = 0.0
+
+    def setRate(self, rate):
+        self.rate = float(rate)
+        self.stepDt = 1.0 / self.rate
+
+    def reset(self):
+        self.accumulator = 0.0
+        self.alpha = 1.0
+
+    def advance(self, frameDt, step):
+        # calls step(dt) with the fixed dt, returns the number of steps done
+        self.accumulator += frameDt
+        steps = 0
+        self.dropped = 0.0
+        while self.accumulator >= self.stepDt and steps < self.maxSubsteps:
+            step(self.stepDt)
+            self.accumulator -= self.stepDt
+            steps += 1
+
+        if self.accumulator >= self.stepDt:
+            # too far behind : give up on the time we can not catch up
+            self.dropped = self.accumulator - self.accumulator % self.stepDt
+            self.droppedTime += self.dropped
+            self.accumulator -= self.dropped
+
+        self.steps += steps
+        self.alpha = self.accumulator / self.stepDt
+        return steps
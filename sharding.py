@@ -0,0 +1,260 @@
+import atexit
+import math
+import multiprocessing
+import traceback
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from swarmcore import CONFIG
+from profiler import PhaseProfiler
+from spatialhash import SpatialHash
+from swarmengine import SwarmEngine, initialFishState
+from swarmmath import directionsToHpr, interpolateDirections
+
+# per fish state exchanged between the processes : (name, shape of one fish)
+STATE_FIELDS = [
+    ("pos", (3,)),
+    ("forward", (3,)),
+    ("scale", ()),
+    ("speed", ()),
+    ("escapeTimeout", ()),
+    ("targetIncidence", (3, 2, 2)),
+    ("targetDirection", (3,)),
+    ("alive", ()),
+]
+
+
+class SharedSwarmState:
+
+    # Two copies of the swarm state in one shared memory block.
+    # During a step the workers read the state of the previous step from one
+    # copy and write the new state of their own fish in the other one, so that
+    # every fish sees its neighbours as they were at the start of the step.
+
+    def __init__(self, count, name=None):
+        floatsPerFish = sum(math.prod(shape) for _, shape in STATE_FIELDS)
+        size = max(2 * count * floatsPerFish * 8, 8)
+        self.shm = shared_memory.SharedMemory(name=name, create=name is None, size=size)
+        self.name = self.shm.name
+        self.count = count
+
+        self.states = []
+        offset = 0
+        for _ in range(2):
+            state = {}
+            for field, shape in STATE_FIELDS:
+                state[field] = np.ndarray((count,) + shape, dtype=np.float64, buffer=self.shm.buf, offset=offset)
+                offset += count * math.prod(shape) * 8
+            self.states.append(state)
+
+    def close(self, unlink=False):
+        self.states = []
+        self.shm.close()
+        if unlink:
+            self.shm.unlink()
+
+
+def computeSlabs(gridDimentions, shards):
+    # split the cubes of the grid along X : limits (in cubes) of each slab
+    nx = gridDimentions[1]
+    shards = max(1, min(shards, nx))
+    return [int(round(i * nx / shards)) for i in range(shards + 1)]
+
+
+def _shardWorker(conn, name, count, gridDimentions, limits, slab, config, boundary, backend, lod):
+
+    CONFIG.update(config)
+    state = SharedSwarmState(count, name)
+    engine = SwarmEngine(np.zeros((count, 3)), np.zeros((count, 3)), 1, gridDimentions)
+    engine.boundary = boundary
+    engine.backend = backend
+    # each worker counts the steps of its own copy : the batches stay in sync
+    engine.lod = lod
+
+    cellSize = gridDimentions[0]
+    gridMinX = -gridDimentions[1] * cellSize / 2
+    # internal slab limits in world coordinates : the owner of a fish only depends on its position
+    boundaries = gridMinX + np.array(limits[1:-1]) * cellSize
+    owned = np.zeros(count, dtype=bool)
+
+    try:
+        while True:
+            message = conn.recv()
+            if message[0] == "stop":
+                break
+            _, dt, tankDimensions, environment, current, viewpoint = message
+            if lod is not None:
+                lod.viewpoint = viewpoint
+            src, dst = state.states[current], state.states[1 - current]
+
+            x = src["pos"][:, 0]
+            # despawned fish are owned by no slab
+            alive = src["alive"] > 0
+            mine = (np.searchsorted(boundaries, x, side="right") == slab) & alive
+
+            # halo : fish of the neighbour slabs close enough to be neighbours of our fish
+            engine.scale[:] = src["scale"]
+            engine.alive[:] = alive
+            halo = math.ceil(engine.neighbourRadius() / cellSize) * cellSize
+            low = boundaries[slab - 1] - halo if slab > 0 else -np.inf
+            high = boundaries[slab] + halo if slab < len(boundaries) else np.inf
+            visible = mine | ((x >= low) & (x < high) & alive)
+
+            localIdx = np.nonzero(visible)[0]
+            for field, _ in STATE_FIELDS:
+                getattr(engine, field)[localIdx] = src[field][localIdx]
+
+            fishIdx = np.nonzero(mine)[0]
+            engine.step(dt, tankDimensions, environment, fishIdx, visible)
+            for field, _ in STATE_FIELDS:
+                dst[field][fishIdx] = getattr(engine, field)[fishIdx]
+
+            # fish handed over by the neighbour slabs during the last step
+            arrived = int(np.count_nonzero(mine & ~owned))
+            owned = mine
+            conn.send(("done", len(fishIdx), len(localIdx) - len(fishIdx), arrived))
+    except Exception:
+        conn.send(("error", traceback.format_exc()))
+    finally:
+        state.close()
+        conn.close()
+
+
+class ShardedSwarm:
+
+    # SwarmEngine split over worker processes.
+    # The tank grid is cut in slabs along X, each worker steps the fish located
+    # in its slab, seeing the fish of the neighbour slabs close to its borders
+    # (the halo) through the shared state. A fish crossing a border is simply
+    # updated by the other worker at the next step. The main process only
+    # reads the shared state for the rendering.
+    # The shared state has a fixed number of slots : fish can be despawned and
+    # spawned again in the free slots, not beyond.
+
+    def __init__(self, engine, shards):
+
+        self.count = engine.count
+        self.gridDimentions = engine.gridDimentions
+        self.limits = computeSlabs(engine.gridDimentions, shards)
+
+        self.state = SharedSwarmState(self.count)
+        for field, _ in STATE_FIELDS:
+            for state in self.state.states:
+                state[field][:] = getattr(engine, field)
+        self.current = 0
+        self.slots = engine.slots
+        self.lod = engine.lod
+        self.forwardSpeed = engine.forwardSpeed
+
+        # mapping of the fish to the cubes, for the display
+        self.grid = SpatialHash(self.gridDimentions)
+        self.recordVectors = False
+        self.vectors = None
+        self.profiler = PhaseProfiler(enabled=False)
+
+        # statistics of the last step
+        self.owned = np.zeros(len(self.limits) - 1, dtype=np.int64)
+        self.halo = np.zeros(len(self.limits) - 1, dtype=np.int64)
+        self.migrations = 0
+
+        context = multiprocessing.get_context("spawn")
+        self.connections = []
+        self.processes = []
+        for slab in range(len(self.limits) - 1):
+            conn, child = context.Pipe()
+            process = context.Process(target=_shardWorker, daemon=True,
+                                      args=(child, self.state.name, self.count, list(self.gridDimentions),
+                                            self.limits, slab, dict(CONFIG), engine.boundary, engine.backend, engine.lod))
+            process.start()
+            child.close()
+            self.connections.append(conn)
+            self.processes.append(process)
+        print(f"Swarm of {self.count} fish sharded over {len(self.processes)} processes")
+        atexit.register(self.close)
+
+    @property
+    def pos(self):
+        return self.state.states[self.current]["pos"]
+
+    @property
+    def forward(self):
+        return self.state.states[self.current]["forward"]
+
+    @property
+    def hpr(self):
+        return directionsToHpr(self.forward)
+
+    @property
+    def alive(self):
+        return self.slots.alive
+
+    @property
+    def scale(self):
+        return self.state.states[self.current]["scale"]
+
+    @property
+    def speed(self):
+        return self.state.states[self.current]["speed"]
+
+    @property
+    def escapeTimeout(self):
+        return self.state.states[self.current]["escapeTimeout"]
+
+    def spawn(self, positions, hprs, scales):
+        # add fish in free slots, returns their slot ids
+        state = initialFishState(positions, hprs, scales, self.forwardSpeed)
+        if len(state["pos"]) > len(self.slots.free):
+            raise ValueError(f"Only {len(self.slots.free)} free slots in the sharded swarm of {self.count} fish")
+        ids = self.slots.allocate(len(state["pos"]))
+        # in both copies : the workers read one, the rendering interpolates from the other
+        for copy in self.state.states:
+            for field, values in state.items():
+                copy[field][ids] = values
+            copy["alive"][ids] = 1
+        return ids
+
+    def despawn(self, ids):
+        ids = self.slots.release(ids)
+        for copy in self.state.states:
+            copy["alive"][ids] = 0
+        return ids
+
+    def interpolate(self, alpha):
+        previous = self.state.states[1 - self.current]
+        return interpolateDirections(previous["pos"], previous["forward"], self.pos, self.forward, alpha)
+
+    def step(self, dt, tankDimensions, environment=None):
+
+        with self.profiler.phase("spatialDistribution"):
+            self.grid.update(self.pos, self.alive)
+        with self.profiler.phase("shards"):
+            viewpoint = self.lod.viewpoint if self.lod is not None else None
+            for conn in self.connections:
+                conn.send(("step", dt, tuple(tankDimensions), environment, self.current, viewpoint))
+            replies = [conn.recv() for conn in self.connections]
+        for reply in replies:
+            if reply[0] == "error":
+                self.close()
+                raise RuntimeError(f"Swarm shard failed:\n{reply[1]}")
+
+        self.current = 1 - self.current
+        self.owned[:] = [reply[1] for reply in replies]
+        self.halo[:] = [reply[2] for reply in replies]
+        self.migrations = sum(reply[3] for reply in replies)
+        self.profiler.count("migrations", self.migrations)
+
+    def close(self):
+        if not self.processes:
+            return
+        for conn, process in zip(self.connections, self.processes):
+            try:
+                conn.send(("stop",))
+            except OSError:
+                # the worker already exited
+                pass
+            process.join()
+            conn.close()
+        self.connections = []
+        self.processes = []
+        self.state.close(unlink=True)
@@ -0,0 +1,42 @@
+import numpy as np
+
+
+class SlotTable:
+
+    # Stable ids of the fish of a swarm.
+    # A fish keeps its slot (its row in the state arrays, its node, its
+    # bucket entries in the grid) as long as it lives. A despawned fish only
+    # frees its slot, reused by the next spawned fish, so that the ids of the
+    # other fish never change.
+
+    def __init__(self, count=0):
+        self.alive = np.ones(count, dtype=bool)
+        self.free = []
+
+    def __len__(self):
+        return int(np.count_nonzero(self.alive))
+
+    @property
+    def capacity(self):
+        # number of slots, alive or free
+        return len(self.alive)
+
+    def liveIdx(self):
+        return np.nonzero(self.alive)[0]
+
+    def allocate(self, count):
+        # ids of count new fish : free slots first, then new slots at the end
+        reused = [self.free.pop() for _ in range(min(count, len(self.free)))]
+        added = np.arange(self.capacity, self.capacity + count - len(reused))
+        self.alive = np.concatenate([self.alive, np.zeros(len(added), dtype=bool)])
+        ids = np.concatenate([np.array(reused, dtype=np.int64), added])
+        self.alive[ids] = True
+        return ids
+
+    def release(self, ids):
+        ids = np.unique(np.asarray(ids, dtype=np.int64))
+        if not np.all(self.alive[ids]):
+            raise ValueError(f"Fish {ids[~self.alive[ids]].tolist()} already despawned")
+        self.alive[ids] = False
+        self.free.extend(ids.tolist())
+        return ids
@@ -0,0 +1,93 @@
+import numpy as np
+
+
+class SpatialHash:
+
+    # Persistent mapping between the cubes of the spatial grid and the fish.
+    # Cubes are identified by a flat integer id, a fish is only moved from
+    # one bucket to another when its cube actually changes.
+
+    def __init__(self, gridDimentions):
+
+        self.cellSize = gridDimentions[0]
+        self.dims = np.array(gridDimentions[1:4], dtype=np.int64)
+        self.cellCount = int(np.prod(self.dims))
+        self.gridMin = -self.dims * self.cellSize / 2
+
+        # cube id => set of fish idx
+        self.buckets = {}
+        self.occupancy = np.zeros(self.cellCount, dtype=np.int64)
+
+        # per fish: 3D cube coordinates and flat id (-1 when outside of the grid)
+        self.fishCoords = np.zeros((0, 3), dtype=np.int64)
+        self.fishCells = np.zeros(0, dtype=np.int64)
+
+        self._csr = None
+
+    def computeCoords(self, positions):
+        return np.floor_divide(np.asarray(positions, dtype=np.float64) - self.gridMin, self.cellSize).astype(np.int64)
+
+    def computeCellIds(self, coords):
+        inGrid = np.all((coords >= 0) & (coords < self.dims), axis=1)
+        ids = np.full(len(coords), -1, dtype=np.int64)
+        ids[inGrid] = np.ravel_multi_index(coords[inGrid].T, self.dims)
+        return ids
+
+    def getCoords(self, cellId):
+        return tuple(int(c) for c in np.unravel_index(cellId, self.dims))
+
+    def getFish(self, cellId):
+        return self.buckets.get(cellId, ())
+
+    def update(self, positions, visible=None):
+        # returns the idx of the fish that changed of cube
+        # visible : optional mask, the other fish are kept out of the grid
+
+        coords = self.computeCoords(positions)
+        ids = self.computeCellIds(coords)
+        if visible is not None:
+            ids[~visible] = -1
+        self.fishCoords = coords
+
+        # the swarm may have been resized : new fish are not yet in any bucket
+        previous = np.full(len(ids), -1, dtype=np.int64)
+        keep = min(len(self.fishCells), len(ids))
+        previous[:keep] = self.fishCells[:keep]
+        removed = self.fishCells[keep:]
+
+        moved = np.nonzero(ids != previous)[0]
+        if len(moved) == 0 and len(removed) == 0:
+            return moved
+
+        for idx, old in enumerate(removed.tolist(), start=keep):
+            self._leave(idx, old)
+        for idx, old, new in zip(moved.tolist(), previous[moved].tolist(), ids[moved].tolist()):
+            self._leave(idx, old)
+            if new >= 0:
+                self.buckets.setdefault(new, set()).add(idx)
+                self.occupancy[new] += 1
+        self.fishCells = ids
+        self._csr = None
+        return moved
+
+    def _leave(self, idx, cellId):
+        if cellId < 0:
+            return
+        bucket = self.buckets[cellId]
+        bucket.discard(idx)
+        self.occupancy[cellId] -= 1
+        if not bucket:
+            del self.buckets[cellId]
+
+    def occupiedCells(self):
+        return np.nonzero(self.occupancy)[0]
+
+    def csr(self):
+        # fish sorted by cube : (order, cellStart, occupancy)
+        # only rebuilt when a fish changed of cube since the last call
+        if self._csr is None:
+            members = np.nonzero(self.fishCells >= 0)[0]
+            order = members[np.argsort(self.fishCells[members], kind="stable")]
+            cellStart = np.cumsum(self.occupancy) - self.occupancy
+            self._csr = (order, cellStart, self.occupancy)
+        return self._csr
@@ -4,43 +4,123 @@ from direct.actor.Actor import Actor
 from panda3d.core import PointLight, KeyboardButton, MouseWatcher
 from panda3d.core import LineSegs, NodePath
 import random
+import numpy as np
 from direct.task import Task
 from panda3d.core import Mat3, deg2Rad
 import math
 import sys
+import argparse
+import atexit
 from panda3d.core import Point3, TransparencyAttrib,TextNode
 from direct.gui.DirectGui import DirectFrame, DirectButton, DGG, DirectCheckButton
 from panda3d.core import OrthographicLens,PerspectiveLens
 
 from basesimulation import BaseSimulation, BaseSimulationWithDrawer
-from fish import FishActor, createFish
-from factory import mkCube, mkSpatialGrid
+from fish import FishActor, createFish, createFishNode
+from swarmcore import randomFishHpr, gridLayout, triangleLayout, FISH_LENGTH, GRID_SEGMENTS
+from factory import mkCube, mkSpatialGrid, mkCylinderWireframe, mkSphereWireframe, readModelVertices
+from swarmcore import CONFIG, INTERACTION_MAX_RADIUS
+from swarmengine import SwarmEngine, NEIGHBOUR_SKIN, NEIGHBOUR_LIST_EXTRA
+from boundary import VOXEL_SIZE
+from swarmmodel import mkBoundary, mkTankShape
+from boundary import BoxShape, CylinderShape, SphereShape, PointCloudShape
+from swarmmath import interpolateState
+from sharding import ShardedSwarm
+from spatialhash import SpatialHash
+from neighbours import NeighbourQuery, VerletNeighbourList
+from debugvectors import DebugVectorLayer
+from gridoverlay import GridOverlay
+from instancing import InstancedSwarmRenderer, supportsHardwareInstancing
+from culling import FrustumCuller
+from trajectory import TrajectoryWriter, TrajectoryReader
+from fishpool import FishPool
+from environment import EnvironmentIndex
+from slots import SlotTable
+from lod import SimulationLod
+from backends import selectBackend
 
 TANK_DIMENSION = Vec3(1600,900, 200)
 
 DISPLAY_CUBES=True
+# cubes colored by the number of fish they hold instead of occupied / empty
+GRID_HEATMAP=False
+
+# step the swarm with the vectorized SwarmEngine instead of FishActor.swim
+USE_SWARM_ENGINE=True
+
+# display the influence and speed vectors of each fish (toggle with 'v')
+DISPLAY_VECTORS=True
+
+# draw the swarm with GPU instancing of a single model (requires USE_SWARM_ENGINE)
+INSTANCED_RENDERING=False
+
+# only update the nodes / instances / debug vectors of the fish the camera can see
+FRUSTUM_CULLING=True
+
+# kernels of the SwarmEngine : "numpy", "python" (reference loops), "numba" (compiled loops)
+# or "auto" (numba when installed, numpy otherwise)
+COMPUTE_BACKEND="auto"
+
+# number of worker processes stepping the swarm (0 : stepped in the main process)
+# each worker owns a slab of the tank along X (requires USE_SWARM_ENGINE)
+SHARDED_WORKERS=0
+
+FISH_MODEL="fish-ani"
+
+# shape of the tank : "box" or "cylinder" (vertical, inscribed in TANK_DIMENSION)
+TANK_SHAPE="box"
+
+# keep the fish in the water with a precomputed distance field (any tank shape, obstacles)
+# instead of testing the box faces one by one (requires USE_SWARM_ENGINE)
+DISTANCE_FIELD_BOUNDARY=True
+
+# static obstacles avoided by the fish, shapes of boundary.py
+# e.g. [CylinderShape(80, 200, (400, 0, 0)), SphereShape(150, (-600, 300, -200))]
+TANK_OBSTACLES=[]
+# obstacles loaded from model files : (path, position, scale)
+OBSTACLE_MODELS=[]
+
+# fish added / removed at once with the '=' / '-' keys
+SPAWN_BATCH=10
+
+# simulation level of detail : the fish further than LOD_NEAR_DISTANCE from the camera
+# only compute their neighbours and influences every LOD_PERIOD steps, in round robin batches
+SIMULATION_LOD=False
+LOD_NEAR_DISTANCE=500
+LOD_PERIOD=4
 
 class FishTankSimulation(BaseSimulationWithDrawer):
     
-    def __init__(self):
+    def __init__(self, headless=False, withModels=None, replay=None):
+        # replay : trajectory file played back instead of simulating the swarm
 
-        BaseSimulationWithDrawer.__init__(self)
-    
-        # Scene initialization
-        self.setupLights()
+        BaseSimulationWithDrawer.__init__(self, headless)
 
-        # take over camera control
-        self.disableMouse()  
-        self.setupCamera()
-        self.setupNavigationControls()
+        # headless runs do not need the fish models unless requested
+        if withModels is None:
+            withModels = not headless
+        if not headless:
+            with self.startup.phase("scene"):
+                # Scene initialization
+                self.setupLights()
 
-        #self.toggle2DView()
-        #self.setTopView()
+                # take over camera control
+                self.disableMouse()  
+                self.setupCamera()
+                self.setupNavigationControls()
 
-        # Drawer to configure simulation
-        self.setupDrawer()
+                #self.toggle2DView()
+                #self.setTopView()
 
-        # Pre-load models
+                # Drawer to configure simulation
+                self.setupDrawer(DISPLAY_VECTORS, DISPLAY_CUBES)
+
+                # schools entering / leaving the tank
+                self.accept("=", self.spawnRandomFish)
+                self.accept("-", self.despawnRandomFish)
+
+        # Models, loaded on first use : only the fish model is loaded (in the background
+        # while the tank is set up)
         # NOTE: fish-ani.gltf causes segfault with Panda3D 1.10.15 and Python 3.12
         # Using koifish.egg instead which is more compatible
         modelMappings = {
@@ -48,46 +128,336 @@ class FishTankSimulation(BaseSimulationWithDrawer):
             "fish-ani": { "path" : "koifish.egg", "scale": 0.8},  # Changed from fish-ani.gltf to koifish.egg
             "fish-egg": { "path" : "koifish.egg", "scale": 0.8} 
         }
-        self.loadModels(modelMappings)
+        if withModels:
+            self.loadModels(modelMappings, preload=[FISH_MODEL])
+        else:
+            self.modelMappings = modelMappings
 
         # create the Tank
-        self.setupTank(TANK_DIMENSION, thickness=5.0, color=[0.4,0.75,1])
-
-        self.setupEnvironment()
+        self.debugVectors = None
+        loading = None
+        if not headless:
+            with self.startup.phase("tank"):
+                self.setupTank(TANK_DIMENSION, thickness=5.0, color=[0.4,0.75,1])
+                self.debugVectors = DebugVectorLayer(self.render)
+                self.debugVectors.setEnabled(DISPLAY_VECTORS)
+                self.setTopView()
+                # the window shows the tank during the rest of the startup
+                loading = self.showLoadingText("Loading...")
+
+        with self.startup.phase("boundary"):
+            self.setupEnvironment()
+            self.setupBoundary()
+
+        with self.startup.phase("grid"):
+            # Init the spatial gr
+            grid, gridDimentions = mkSpatialGrid(TANK_DIMENSION, GRID_SEGMENTS)
+            grid.reparentTo(self.render)
+            self.gridDimentions = gridDimentions
+
+            # cubes display, only built when first enabled
+            self.gridOverlay = None
+            if not headless:
+                self.gridOverlay = GridOverlay(grid, gridDimentions, GRID_HEATMAP)
+                self.gridOverlay.setEnabled(DISPLAY_CUBES)
+        
+        # maps cube to fish
+        # cube id => {fish_idx1, fish_idx2}
+        self.spatialHash=None
+
+        # trajectory recording / replay
+        self.recorder=None
+        self.replay=TrajectoryReader(replay) if replay is not None else None
+        atexit.register(self.stopRecording)
+
+        # fish out of the camera view are not rendered
+        self.culler=None
+        if FRUSTUM_CULLING and not headless:
+            with self.startup.phase("models"):
+                model = self.getModel(FISH_MODEL)
+            fishRadius = model.getBounds().getRadius() * self.getModelScaling(FISH_MODEL) * FISH_LENGTH
+            self.culler=FrustumCuller(self.cam, self.render, fishRadius)
 
         # Create fish group
-        self.setupSwarm()
+        self.backend=selectBackend(COMPUTE_BACKEND)
+        # fish nodes are reused from one setupSwarm to the next (e.g. Reset)
+        self.fishPool=FishPool(self.render, self.createFish)
+        self.simulationLod=SimulationLod(LOD_NEAR_DISTANCE, LOD_PERIOD) if SIMULATION_LOD else None
+        self.swarmRenderer=None
+        self.swarmEngine=None
+        with self.startup.phase("swarm"):
+            if self.replay is not None:
+                self.setupReplay()
+            else:
+                self.setupSwarm()
+
+        if loading is not None:
+            loading.destroy()
+        if headless:
+            self.startup.finish()
 
         #self.fishSwarm = self.createSwarm(w=1, l=1, spacing=60)
-
-        # Init the spatial gr
-        grid, gridCubes, gridDimentions = mkSpatialGrid(TANK_DIMENSION,5)
-        grid.reparentTo(self.render)
-
-        self.gridCubes = gridCubes
-        self.gridDimentions = gridDimentions
-        
-        # maps cube to fish
-        # (x,y,z) => [fish_idx1, fish_idx2]
-        self.gridMapping={}
        
         #self.freeze=True
-        self.setTopView()
         #self.setSideView()
     
-    def setupSwarm(self):
-
-        for npath in self.render.getChildren():
-            if  npath.name.startswith("fish_"):
-                npath.remove_node()
+    def setupSwarm(self, layout=None):
  
-        #self.fishSwarm = self.createSwarm(w=7, l=5, spacing=50)
-        self.fishSwarm = self.createTriangleSwarm(15, 8, spacing=60)
-        #self.fishSwarm = self.createTriangleSwarm(2, 2, spacing=50)
-        
+        if layout is None:
+            #layout = gridLayout(w=7, l=5, spacing=50)
+            layout = triangleLayout(15, 8, spacing=60)
+            #layout = triangleLayout(2, 2, spacing=50)
+
+        if self.swarmEngine is not None:
+            self.swarmEngine.close()
+        self.swarmEngine = None
+        # one node per fish slot, unless the engine state is drawn directly
+        self.useFishNodes = not (USE_SWARM_ENGINE and (INSTANCED_RENDERING or self.headless))
+        if not self.useFishNodes:
+            # no node per fish : the engine holds the state, the renderer (if any) draws it
+            self.fishSwarm = self.fishPool.acquire([])
+            hprs = [randomFishHpr() for _ in layout]
+            scale = self.getModelScaling(FISH_MODEL) * FISH_LENGTH
+            self.swarmEngine = SwarmEngine(layout, hprs, scale, self.gridDimentions)
+            if self.swarmRenderer is None and not self.headless:
+                self.swarmRenderer = InstancedSwarmRenderer(self.render, self.getModel(FISH_MODEL), len(layout),
+                                                            supportsHardwareInstancing(self.win))
+        else:
+            self.fishSwarm = self.createFishes(layout)
+            if USE_SWARM_ENGINE:
+                self.swarmEngine = self.createSwarmEngine(self.fishSwarm)
+
+        if self.swarmEngine is not None:
+            self.swarmEngine.boundary = self.boundary
+            self.swarmEngine.backend = self.backend
+            self.swarmEngine.lod = self.simulationLod
+        if self.swarmEngine is not None and SHARDED_WORKERS > 0:
+            self.swarmEngine = ShardedSwarm(self.swarmEngine, SHARDED_WORKERS)
+
+        if self.swarmEngine is not None:
+            self.swarmEngine.profiler = self.profiler
+            self.spatialHash = self.swarmEngine.grid
+            self.fishSlots = self.swarmEngine.slots
+        else:
+            self.spatialHash = SpatialHash(self.gridDimentions)
+            self.fishSlots = SlotTable(len(self.fishSwarm))
+        # the pool shows every node it hands out
+        self.shownNodes = np.ones(len(self.fishSwarm), dtype=bool)
+        self.neighbourQuery = NeighbourQuery(self.spatialHash)
+        self.neighbourLists = VerletNeighbourList(self.neighbourQuery, NEIGHBOUR_LIST_EXTRA)
+
+    def spawnFish(self, positions):
+        # add fish to the running simulation, returns their slot ids
+        # (the ids of the other fish do not change)
+        if self.replay is not None:
+            raise RuntimeError("No fish can be spawned during a replay")
+        positions = [tuple(p) for p in positions]
+        if self.swarmEngine is not None:
+            hprs = [randomFishHpr() for _ in positions]
+            slots = self.swarmEngine.spawn(positions, hprs, self.getModelScaling(FISH_MODEL) * FISH_LENGTH)
+        else:
+            slots = self.fishSlots.allocate(len(positions))
+        if self.useFishNodes:
+            for slot, (x, y, z) in zip(slots.tolist(), positions):
+                fish = self.fishPool.acquireSlot(slot, x, y, z)
+                if slot == len(self.fishSwarm):
+                    self.fishSwarm.append(fish)
+            # the pool shows the nodes of the new fish
+            self.shownNodes = np.concatenate([self.shownNodes, np.ones(len(self.fishSwarm) - len(self.shownNodes), dtype=bool)])
+            self.shownNodes[slots] = True
+        return slots
+
+    def despawnFish(self, slots):
+        # remove fish from the running simulation, their slots are reused by the next spawned fish
+        if self.replay is not None:
+            raise RuntimeError("No fish can be despawned during a replay")
+        if self.swarmEngine is not None:
+            slots = self.swarmEngine.despawn(slots)
+        else:
+            slots = self.fishSlots.release(slots)
+        if self.useFishNodes:
+            for slot in slots.tolist():
+                self.fishPool.releaseSlot(slot)
+            self.shownNodes[slots] = False
+        return slots
+
+    def spawnRandomFish(self, count=SPAWN_BATCH):
+        positions = [tuple(TANK_DIMENSION[i] * random.uniform(-0.8, 0.8) for i in range(3)) for _ in range(count)]
+        self.spawnFish(positions)
+        print(f"{len(self.fishSlots)} fish")
+
+    def despawnRandomFish(self, count=SPAWN_BATCH):
+        live = self.fishSlots.liveIdx().tolist()
+        self.despawnFish(random.sample(live, min(count, len(live))))
+        print(f"{len(self.fishSlots)} fish")
+
+    def createSwarmEngine(self, fishSwarm):
+        # the engine takes over the simulation state of the fish nodes
+        positions = [fish.getPos() for fish in fishSwarm]
+        hprs = [fish.getHpr() for fish in fishSwarm]
+        scales = [fish.getScale()[0] for fish in fishSwarm]
+        return SwarmEngine(positions, hprs, scales, self.gridDimentions)
+
+    def setupReplay(self):
+        # render only : the state of the fish is read from the trajectory file
+        replay = self.replay
+        if replay.frameCount == 0:
+            raise ValueError(f"No frame recorded in {replay.path}")
+        self.scheduler.setRate(1 / replay.dt)
+        self.replayFrame = 0
+        start = replay.frame(0)
+
+        self.fishSwarm = []
+        if INSTANCED_RENDERING and not self.headless:
+            self.swarmRenderer = InstancedSwarmRenderer(self.render, self.getModel(FISH_MODEL), replay.count,
+                                                        supportsHardwareInstancing(self.win))
+        elif not self.headless:
+            model = self.getModel(FISH_MODEL)
+            for idx, (pos, scale) in enumerate(zip(start["pos"].tolist(), replay.scale.tolist())):
+                fish = createFishNode(*pos, model, 1, idx)
+                fish.setScale(scale)
+                fish.reparentTo(self.render)
+                self.fishSwarm.append(fish)
+        self.shownNodes = np.ones(len(self.fishSwarm), dtype=bool)
+        self.writeSwarmNodes(start["pos"], start["hpr"], replay.scale, self.replayAlive(start))
+
+        self.spatialHash = SpatialHash(self.gridDimentions)
+        self.neighbourQuery = NeighbourQuery(self.spatialHash)
+
+        # jump backward / forward in the recording
+        self.accept(",", self.seekReplay, [-1])
+        self.accept(".", self.seekReplay, [1])
+        print(f"Replay of {replay.frameCount} frames of {replay.count} fish from {replay.path}")
+
+    def seekReplay(self, seconds):
+        frame = self.replayFrame + int(round(seconds / self.replay.dt))
+        self.replayFrame = min(max(frame, 0), self.replay.frameCount - 1)
+        self.scheduler.reset()
+
+    def updateReplayNodes(self, alpha=1.0):
+        current = self.replay.frame(self.replayFrame)
+        previous = self.replay.frame(max(self.replayFrame - 1, 0))
+        positions, hprs = interpolateState(previous["pos"], previous["hpr"], current["pos"], current["hpr"], alpha)
+        self.writeSwarmNodes(positions, hprs, self.replay.scale, self.replayAlive(current))
+
+    def replayAlive(self, frame):
+        # mask of the fish alive in a recorded frame (None : all of them)
+        return frame["alive"] > 0 if "alive" in frame else None
+
+    def updateSwarmNodes(self, alpha=1.0):
+        # write the engine state to the scene graph, once per frame
+        engine = self.swarmEngine
+        positions, hprs = engine.interpolate(alpha)
+        self.writeSwarmNodes(positions, hprs, engine.scale, engine.alive)
+
+    def writeSwarmNodes(self, positions, hprs, scales, alive=None):
+        # only the live fish the camera can see are written : the nodes of the
+        # others are stashed (not drawn nor animated) until they are back in view
+        shown = np.ones(len(positions), dtype=bool) if alive is None else alive.copy()
+        if self.culler is not None:
+            shown &= self.culler.visible(positions)
+        self.profiler.setLevel("fishShown", int(np.count_nonzero(shown)))
+        if self.swarmRenderer is not None:
+            self.swarmRenderer.update(positions, hprs, scales, shown)
+            return
+        if len(self.fishSwarm) == 0:
+            return
+        self.showSwarmNodes(shown)
+        shownIdx = np.nonzero(shown)[0]
+        for idx, pos, hpr in zip(shownIdx.tolist(), positions[shownIdx].tolist(), hprs[shownIdx].tolist()):
+            self.fishSwarm[idx].setPosHpr(pos[0], pos[1], pos[2], hpr[0], hpr[1], hpr[2])
+
+    def showSwarmNodes(self, shown):
+        # stash / unstash the nodes of the fish leaving / entering the view
+        for idx in np.nonzero(shown & ~self.shownNodes)[0].tolist():
+            self.fishSwarm[idx].unstash()
+        for idx in np.nonzero(self.shownNodes & ~shown)[0].tolist():
+            self.fishSwarm[idx].stash()
+        self.shownNodes = shown
+
+    def visibleFish(self, positions):
+        # mask of the fish the camera can see (all of them without culling)
+        if self.culler is None:
+            return np.ones(len(positions), dtype=bool)
+        return self.culler.visible(positions)
+
+    def startRecording(self, path, dt=None):
+        # record the state of the swarm after every step
+        self.stopRecording()
+        if self.swarmEngine is not None:
+            count, scale = self.swarmEngine.count, self.swarmEngine.scale
+        else:
+            count, scale = len(self.fishSwarm), [fish.getScale()[0] for fish in self.fishSwarm]
+        self.recorder = TrajectoryWriter(path, count, scale, self.scheduler.stepDt if dt is None else dt)
+
+    def stopRecording(self):
+        if self.recorder is not None:
+            self.recorder.close()
+            self.recorder = None
+
+    def recordState(self):
+        engine = self.swarmEngine
+        if engine is not None:
+            pos, hpr, speed, escapeTimeout = engine.pos, engine.hpr, engine.speed, engine.escapeTimeout
+            alive = engine.alive
+        else:
+            pos = np.array([tuple(fish.getPos()) for fish in self.fishSwarm]).reshape(-1, 3)
+            hpr = np.array([tuple(fish.getHpr()) for fish in self.fishSwarm]).reshape(-1, 3)
+            speed = [fish.speedVec[0] for fish in self.fishSwarm]
+            escapeTimeout = [fish.escapeTimeout for fish in self.fishSwarm]
+            alive = self.fishSlots.alive
+        if len(pos) != self.recorder.count:
+            print("The swarm size changed : recording stopped")
+            self.stopRecording()
+            return
+        cells = self.spatialHash.computeCellIds(self.spatialHash.computeCoords(pos))
+        self.recorder.append(pos=pos, hpr=hpr, speed=speed, cell=cells, escapeTimeout=escapeTimeout, alive=alive)
+
+    def getEnvironmentState(self):
+        # the environment objects as seen by the engine, kept up to date by
+        # addEnvironmentObject / moveEnvironmentObject
+        return self.environmentIndex
+
+    def addEnvironmentObject(self, kind, nodePath):
+        # kind : "attractors", "repulsors" or "aligners"
+        objectId = self.environmentIndex.add(kind, tuple(nodePath.getPos()), tuple(nodePath.getHpr()))
+        nodePath.setPythonTag("environmentId", objectId)
+        self.environment[kind].append(nodePath)
+        self.environmentNodes[objectId] = nodePath
+
+    def moveEnvironmentObject(self, nodePath, pos):
+        nodePath.setPos(pos)
+        self.environmentIndex.move(nodePath.getPythonTag("environmentId"), tuple(pos))
+
+    def nearbyEnvironments(self, positions):
+        # environment of each fish for FishActor.swim : only the objects in range
+        # (attractors and repulsors further than INTERACTION_MAX_RADIUS are ignored by the fish)
+        environments = [{kind: [] for kind in self.environment} for _ in positions]
+        positions = np.asarray(positions, dtype=np.float64).reshape(-1, 3)
+        for kind in self.environment:
+            radius = None if kind == "aligners" else INTERACTION_MAX_RADIUS
+            rows, objects = self.environmentIndex.query(kind, positions, radius)
+            for row, objectId in zip(rows.tolist(), objects.tolist()):
+                environments[row][kind].append(self.environmentNodes[objectId])
+        return environments
 
     def resetSimulation(self):
+        if self.replay is not None:
+            self.seekReplay(-self.replayFrame * self.replay.dt)
+            return
         self.setupSwarm()
+        self.scheduler.reset()
+
+    def toggleDebugVectors(self, status=None):
+        # status : state of the checkbox, None for the 'v' key (toggle)
+        if self.debugVectors is None:
+            return
+        enabled = not self.debugVectors.isEnabled() if status is None else bool(status)
+        self.debugVectors.setEnabled(enabled)
+        self.vectorsCheckbox["indicatorValue"] = int(enabled)
+
+    def isRecordingVectors(self):
+        return self.debugVectors is not None and self.debugVectors.isEnabled()
 
     def setupEnvironment(self):
          self.environment={
@@ -95,116 +465,274 @@ class FishTankSimulation(BaseSimulationWithDrawer):
             "repulsors": [],
             "aligners" : []
         }
+         # objects hashed in cubes : a fish only examines the objects in its range
+         self.environmentIndex = EnvironmentIndex(INTERACTION_MAX_RADIUS)
+         # object id => node
+         self.environmentNodes = {}
 
         #attractor_path = mkCube([5,5,5], 1, [1,0,0])
         #attractor_path.reparentTo(self.render)
         #attractor_path.setPos(Vec3(-1000,300,0))
-        #self.environment["attractors"].append(attractor_path)
+        #self.addEnvironmentObject("attractors", attractor_path)
 
         #repulsor_path = mkCube([5,5,5], 1, [1,0,0])
         #repulsor_path.reparentTo(self.render)
         #repulsor_path.setPos(Vec3(500,100,0))
-        #self.environment["repulsors"].append(repulsor_path)
+        #self.addEnvironmentObject("repulsors", repulsor_path)
+
+    def setupBoundary(self):
+        # walls and obstacles of the tank as seen by the SwarmEngine
+        obstacles = list(TANK_OBSTACLES)
+        for path, position, scale in OBSTACLE_MODELS:
+            model = self.loader.loadModel(path)
+            model.reparentTo(self.render)
+            model.setPos(*position)
+            model.setScale(scale)
+            # the mesh is approximated by spheres around its vertices
+            obstacles.append(PointCloudShape(readModelVertices(model, self.render), VOXEL_SIZE))
+            if self.headless:
+                model.detachNode()
+
+        self.boundary = mkBoundary(TANK_DIMENSION, TANK_SHAPE, obstacles, DISTANCE_FIELD_BOUNDARY)
+
+        if not self.headless:
+            for obstacle in TANK_OBSTACLES:
+                self.drawShape(obstacle, thickness=2.0, color=[0.8,0.6,0.4])
+
+    def drawShape(self, shape, thickness=1, color=[1,1,1]):
+        if isinstance(shape, CylinderShape):
+            node_path = mkCylinderWireframe(shape.radius, shape.halfHeight, thickness, color)
+        elif isinstance(shape, SphereShape):
+            node_path = mkSphereWireframe(shape.radius, thickness, color)
+        elif isinstance(shape, BoxShape):
+            node_path = mkCube(Vec3(*shape.halfExtents), thickness, color)
+        else:
+            return None
+        node_path.setPos(*shape.center)
+        # static : a single geom without transform
+        node_path.flattenStrong()
+        node_path.reparentTo(self.render)
+        return node_path
 
     def setupTank(self, dimentions=Vec3(1,1,1), thickness=1, color=[1,1,1]):
         
+        if TANK_SHAPE == "cylinder":
+            self.drawShape(mkTankShape(TANK_SHAPE, dimentions), thickness, color)
+            return
+
         # Draw a simple cube
         node_path = mkCube(dimentions, thickness, color)
+        # static : a single geom without transform
+        node_path.flattenStrong()
         node_path.reparentTo(self.render)
     
     def createSwarm(self, w=10, l=5, spacing=100):
-        fishSwarm = []
-        modelName = "fish-ani"
-        model = self.getModel(modelName)
-        scalingRatio = self.getModelScaling(modelName)
-        for i in range(w):
-            for j in range(l):
-                # Calculate the x and y positions for the fish
-                x = (i - w / 2) * spacing 
-                y = (j - l / 2) * spacing 
-                z = 0  
-                # Create and add the fish to the array
-                fish = createFish(x,y,z,model, scalingRatio, len(fishSwarm))
-                fish.reparentTo(self.render)
-                fishSwarm.append(fish)
-        return fishSwarm
+        return self.createFishes(gridLayout(w, l, spacing))
     
     def createTriangleSwarm(self, w=10, max_l=5, spacing=100):
-        fishSwarm = []
-        modelName = "fish-ani"
-        model = self.getModel(modelName)
-        scalingRatio = self.getModelScaling(modelName)
-        l=0
-        for i in range(w):
-            if l< max_l:
-                l+=1
-            for j in range(l):
-                # Calculate the x and y positions for the fish
-                x = ( w / 2 - i) * spacing 
-                y = (j - l / 2) * spacing 
-                z = 0  
-                # Create and add the fish to the array
-                fish = createFish(x,y,z,model, scalingRatio, len(fishSwarm))
-                fish.reparentTo(self.render)
-                fishSwarm.append(fish)
-        return fishSwarm
-    
+        return self.createFishes(triangleLayout(w, max_l, spacing))
 
-    def computeSpacialDistribution(self, display_non_empty_cube=False):
+    def createFishes(self, positions):
+        # pooled fish nodes, only the missing ones are created
+        return self.fishPool.acquire(positions)
 
-        if display_non_empty_cube:
-            # hide previously displayed cubes
-            for ccords in self.gridMapping.keys():
-                try:
-                    self.gridCubes[ccords[0]][ccords[1]][ccords[2]].hide()
-                except IndexError:
-                    pass
+    def createFish(self, x, y, z, idx):
+        # the engine holds the simulation state : plain nodes are enough
+        create = createFishNode if USE_SWARM_ENGINE else createFish
+        return create(x, y, z, self.getModel(FISH_MODEL), self.getModelScaling(FISH_MODEL), idx)
+    
 
-        gridMapping={}
+    def computeSpacialDistribution(self):
 
         # update the mapping between cubes and fishes
-        for idx, fish in enumerate(self.fishSwarm):
-            key = fish.get3DGridCoords(self.gridDimentions)
-            fish.setCube(key)
-            if not key in gridMapping:
-                gridMapping[key]=[]
-            gridMapping[key].append(idx)
-            
-        if display_non_empty_cube:
-            for ccords in gridMapping.keys():
-                try:
-                    self.gridCubes[ccords[0]][ccords[1]][ccords[2]].show()
-                except IndexError:
-                    pass
-
-        self.gridMapping=gridMapping
-
-    def runSimulation(self, task):
-
-        if self.freeze:
-            return task.cont
-
-        if random.randint(0,100)==100:
-            for attractor in self.environment["attractors"]:
-                attractor.setPos(int(TANK_DIMENSION[0]*random.uniform(-0.8, 0.8)), int(TANK_DIMENSION[1]*random.uniform(-0.8, 0.8)), int(TANK_DIMENSION[2]*random.uniform(-0.8, 0.8)))
+        self.fishPositions = [tuple(fish.getPos()) for fish in self.fishSwarm]
+        # despawned fish are kept out of the grid
+        self.spatialHash.update(self.fishPositions, self.fishSlots.alive)
+        for fish, coords in zip(self.fishSwarm, self.spatialHash.fishCoords.tolist()):
+            fish.setCube(coords)
+
+    def isGridDisplayed(self):
+        return self.gridOverlay is not None and self.gridOverlay.isEnabled()
+
+    def toggleGrid(self, status=None):
+        # status : state of the checkbox, None for the 'g' key (toggle)
+        if self.gridOverlay is None:
+            return
+        enabled = not self.gridOverlay.isEnabled() if status is None else bool(status)
+        self.gridOverlay.setEnabled(enabled)
+        self.gridCheckbox["indicatorValue"] = int(enabled)
+
+    def updateCubeDisplay(self):
+        # only the cubes whose occupancy changed are redrawn
+        self.gridOverlay.update(self.spatialHash.occupancy)
+
+    def stepSimulation(self, dt):
+
+        profiler = self.profiler
+        if self.replay is not None:
+            # next recorded frame, back to the start at the end of the file
+            self.replayFrame = (self.replayFrame + 1) % self.replay.frameCount
+            if self.isGridDisplayed():
+                with profiler.phase("spatialDistribution"):
+                    frame = self.replay.frame(self.replayFrame)
+                    self.spatialHash.update(frame["pos"], self.replayAlive(frame))
+            return
+
+        with profiler.phase("attractors"):
+            if random.randint(0,100)==100:
+                for attractor in self.environment["attractors"]:
+                    self.moveEnvironmentObject(attractor, Vec3(int(TANK_DIMENSION[0]*random.uniform(-0.8, 0.8)), int(TANK_DIMENSION[1]*random.uniform(-0.8, 0.8)), int(TANK_DIMENSION[2]*random.uniform(-0.8, 0.8))))
+
+        recordVectors = self.isRecordingVectors()
+
+        if self.simulationLod is not None and not self.headless:
+            # the fish near the camera are updated every step
+            self.simulationLod.viewpoint = tuple(self.camera.getPos(self.render))
+
+        if self.swarmEngine is not None:
+            self.swarmEngine.recordVectors = recordVectors
+            self.swarmEngine.step(dt, TANK_DIMENSION, self.getEnvironmentState())
+        else:
+            self.stepFishActors(dt, recordVectors)
+
+        if self.recorder is not None:
+            with profiler.phase("record"):
+                self.recordState()
+
+    def stepFishActors(self, dt, recordVectors):
+
+        profiler = self.profiler
 
         # the the 3D Cube grid to partition the space
         # map each fish to a cube
-        self.computeSpacialDistribution(DISPLAY_CUBES)
+        with profiler.phase("spatialDistribution"):
+            self.computeSpacialDistribution()
+        with profiler.phase("environment"):
+            environments = self.nearbyEnvironments(self.fishPositions)
+
+        # fish computing their influences this step (all of them without LOD) => dt multiplier
+        live = self.fishSlots.liveIdx()
+        positions = np.array(self.fishPositions).reshape(-1, 3)
+        if self.simulationLod is not None:
+            near, batch = self.simulationLod.select(positions, live)
+            periods = dict.fromkeys(near.tolist(), 1)
+            periods.update(dict.fromkeys(batch.tolist(), self.simulationLod.period))
+            profiler.count("lodNear", self.simulationLod.nearCount)
+            profiler.count("lodBatch", self.simulationLod.batchCount)
+        else:
+            periods = dict.fromkeys(live.tolist(), 1)
+        profiler.count("influenceUpdates", len(periods))
+
+        with profiler.phase("neighbours"):
+            # neighbours further than the attraction radius have no influence
+            updatedIdx = np.array(sorted(periods), dtype=np.int64)
+            scale = max((self.fishSwarm[idx].getScale()[0] for idx in live.tolist()), default=0)
+            table = self.neighbourLists.kNearestBatch(positions, updatedIdx, CONFIG["neighbours"],
+                                                      CONFIG["fishAttractdRadius"] * scale, NEIGHBOUR_SKIN * scale)
+            neighbourRows = dict(zip(updatedIdx.tolist(), table.tolist()))
+        profiler.count("neighboursExamined", self.neighbourLists.examined)
+        profiler.count("neighbourListBuilds", int(self.neighbourLists.rebuilt))
+        profiler.setLevel("neighbourListHitRate", self.neighbourLists.hitRate())
+
+        # debug vectors of the fish in view only
+        recording = self.visibleFish(positions) if recordVectors else np.zeros(len(positions), dtype=bool)
 
         # Call computeMove for each fish every frame
-        for fish in self.fishSwarm:
-            neighboursIdx=fish.computeNeighBours(self.gridDimentions, self.gridMapping, 2)
-            neighbours=[]
-            for idx in neighboursIdx:
-                if self.fishSwarm[idx].name !=fish.name:
-                    neighbours.append(self.fishSwarm[idx])
-            if len(neighbours)>6:
-                neighbours.sort(key = lambda f : (f.getPos()-fish.getPos()).length())
-                neighbours=neighbours[:6]
-            fish.swim(self.render, neighbours, TANK_DIMENSION, self.environment)
-        return task.cont
+        for idx in live.tolist():
+            fish = self.fishSwarm[idx]
+            if idx not in periods:
+                # far fish out of this step batch : keep swimming
+                fish.vectors = [] if recording[idx] else None
+                with profiler.phase("swim"):
+                    fish.swim(self.render, None, TANK_DIMENSION, None, dt)
+                continue
+            neighbours = [self.fishSwarm[n] for n in neighbourRows[idx] if n >= 0]
+            fish.vectors = [] if recording[idx] else None
+            # computeInfluence + stayInTank + move of the FishActor
+            with profiler.phase("swim"):
+                fish.swim(self.render, neighbours, TANK_DIMENSION, environments[idx], dt, dt * periods[idx])
+
+    def updateScene(self, alpha):
+
+        profiler = self.profiler
+        recordVectors = self.isRecordingVectors()
+
+        if self.replay is not None:
+            with profiler.phase("nodes"):
+                self.updateReplayNodes(alpha)
+        elif self.swarmEngine is not None:
+            with profiler.phase("nodes"):
+                self.updateSwarmNodes(alpha)
+            if recordVectors and self.swarmEngine.vectors is not None:
+                with profiler.phase("vectors"):
+                    starts, ends, kinds = self.swarmEngine.vectors
+                    # vectors of the fish in view only
+                    inView = self.visibleFish(starts)
+                    self.debugVectors.draw(starts[inView], ends[inView], kinds[inView])
+                profiler.setLevel("vectorsDrawn", int(np.count_nonzero(inView)))
+        else:
+            # the fish nodes hold the simulation state : no interpolation,
+            # the nodes out of view are only stashed
+            with profiler.phase("nodes"):
+                positions = np.array([tuple(fish.getPos()) for fish in self.fishSwarm]).reshape(-1, 3)
+                shown = self.fishSlots.alive & self.visibleFish(positions)
+                self.showSwarmNodes(shown)
+                profiler.setLevel("fishShown", int(np.count_nonzero(shown)))
+            if recordVectors:
+                with profiler.phase("vectors"):
+                    self.drawFishVectors()
+
+        if self.isGridDisplayed():
+            with profiler.phase("cubes"):
+                self.updateCubeDisplay()
+        profiler.setLevel("cellsOccupied", int(np.count_nonzero(self.spatialHash.occupancy)))
+
+    def drawFishVectors(self):
+        # gather the vectors recorded by each FishActor into the debug layer
+        starts, ends, kinds = [], [], []
+        for idx in self.fishSlots.liveIdx().tolist():
+            fish = self.fishSwarm[idx]
+            if fish.vectors is None:
+                continue
+            pos = fish.getPos()
+            for kind, vect in fish.vectors:
+                starts.append(tuple(pos))
+                ends.append(tuple(pos + vect))
+                kinds.append(kind)
+        self.debugVectors.draw(np.array(starts).reshape(-1, 3), np.array(ends).reshape(-1, 3), np.array(kinds, dtype=np.int64))
+        self.profiler.setLevel("vectorsDrawn", len(kinds))
+
+
+def parseArguments(argv):
+    parser = argparse.ArgumentParser(description="Fish tank swarm simulation")
+    parser.add_argument("--headless", action="store_true", help="no window : step the swarm with a fixed dt and report steps/sec")
+    parser.add_argument("--steps", type=int, default=1000, help="number of steps in headless mode")
+    parser.add_argument("--dt", type=float, default=1/60, help="fixed time step in headless mode (seconds)")
+    parser.add_argument("--models", action="store_true", help="load the fish models in headless mode")
+    parser.add_argument("--trace", default=None, help="write the per step profiler trace to this .csv/.json file in headless mode")
+    parser.add_argument("--record", default=None, help="record the swarm state of every step to this trajectory file")
+    parser.add_argument("--replay", default=None, help="play back a trajectory file instead of simulating")
+    parser.add_argument("--backend", choices=["auto", "numpy", "python", "numba"], default=COMPUTE_BACKEND, help="compute backend of the swarm engine")
+    parser.add_argument("--workers", type=int, default=SHARDED_WORKERS, help="number of processes stepping the swarm (0 : main process only)")
+    return parser.parse_args(argv)
 
 if __name__ == "__main__":
-    app = FishTankSimulation()
-    app.run()
+    args = parseArguments(sys.argv[1:])
+    SHARDED_WORKERS = args.workers
+    COMPUTE_BACKEND = args.backend
+    if args.headless:
+        app = FishTankSimulation(headless=True, withModels=args.models)
+        if args.trace:
+            app.profiler.startTrace()
+        if args.record:
+            app.startRecording(args.record, args.dt)
+        app.runHeadless(args.steps, args.dt)
+        app.stopRecording()
+        print(app.profiler.formatStats())
+        if args.trace:
+            app.profiler.stopTrace(args.trace)
+    else:
+        app = FishTankSimulation(replay=args.replay)
+        if args.record:
+            app.startRecording(args.record)
+        app.run()
@@ -0,0 +1,78 @@
+import math
+import random
+
+# Parameters of the swarm model and layouts of the fish, shared by the
+# SwarmEngine (and the modules it builds on) and the Panda3D application.
+# Like them, this module only needs the standard library : the simulation can
+# run without Panda3D (swarmmodel.py).
+
+CONFIG = {
+        "tankAvoid":0.3,
+        "fishCollisionRadius":10,
+        "fishAlignRadius":20,
+        "fishAttractdRadius":50,
+        "catchMargin": 10,
+        "cohesion" : 4,
+        "escapeTimeout" : 0.5, # seconds
+        "FOV": 110,
+        "neighbours": 6
+        }
+
+INTERACTION_MAX_RADIUS=800
+
+# kinds of debug vectors
+VECTOR_ALIGNER=0
+VECTOR_ATTRACTOR=1
+VECTOR_REPULSOR=2
+VECTOR_SPEED=3
+# length ratio of the speed vector
+SPEED_VECTOR_RATIO=0.3
+
+# default length for all fish
+FISH_LENGTH=10
+
+# scale of the fish of the application (model scaling of koifish.egg * FISH_LENGTH)
+FISH_SCALE=8
+
+# number of cubes of the spatial grid along the smallest tank dimension
+GRID_SEGMENTS=5
+
+
+def randomFishHpr():
+    return (random.uniform(-8,8), 0, random.uniform(-5,5))
+
+def gridLayout(w=10, l=5, spacing=100):
+    positions = []
+    for i in range(w):
+        for j in range(l):
+            # Calculate the x and y positions for the fish
+            x = (i - w / 2) * spacing
+            y = (j - l / 2) * spacing
+            z = 0
+            positions.append((x, y, z))
+    return positions
+
+def triangleLayout(w=10, max_l=5, spacing=100):
+    positions = []
+    l=0
+    for i in range(w):
+        if l< max_l:
+            l+=1
+        for j in range(l):
+            # Calculate the x and y positions for the fish
+            x = ( w / 2 - i) * spacing
+            y = (j - l / 2) * spacing
+            z = 0
+            positions.append((x, y, z))
+    return positions
+
+def computeGridDimentions(dimensions, segments=GRID_SEGMENTS):
+    # [cube size, cubes along X, Y, Z] of the spatial grid filling the tank
+    # dimensions : half lengths along X, Y, Z
+    min_width = min(int(dimensions[0]), int(dimensions[1]), int(dimensions[2]))
+    cube_width = math.ceil(min_width/segments)
+    cube_width = max(cube_width, 100)
+    return [cube_width,
+            math.ceil(2*dimensions[0]/cube_width),
+            math.ceil(2*dimensions[1]/cube_width),
+            math.ceil(2*dimensions[2]/cube_width)]
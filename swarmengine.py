@@ -0,0 +1,259 @@
+import numpy as np
+
+from swarmcore import CONFIG, INTERACTION_MAX_RADIUS
+from swarmcore import VECTOR_ALIGNER, VECTOR_ATTRACTOR, VECTOR_REPULSOR, VECTOR_SPEED, SPEED_VECTOR_RATIO
+from spatialhash import SpatialHash
+from neighbours import NeighbourQuery, VerletNeighbourList
+from profiler import PhaseProfiler
+from swarmmath import hprToDirections, directionsToHpr, interpolateDirections, MAX_ELEVATION
+from backends import NumpyBackend, PAIR_ALIGNER, PAIR_ATTRACTOR, PAIR_REPULSOR
+from boundary import BoxBoundary
+from slots import SlotTable
+
+# fastest turn of a fish (degrees per second)
+MAX_TURN_RATE = 360
+
+# neighbour lists (see VerletNeighbourList) : margin beyond fishAttractdRadius
+# (in fish lengths, like the CONFIG radii) and entries kept beyond CONFIG["neighbours"]
+NEIGHBOUR_SKIN = 3
+NEIGHBOUR_LIST_EXTRA = 18
+
+
+def initialFishState(positions, hprs, scales, forwardSpeed):
+    # state of new fish, by field of the engine
+    positions = np.array(positions, dtype=np.float64).reshape(-1, 3)
+    count = len(positions)
+    return {
+        "pos": positions,
+        "forward": hprToDirections(np.array(hprs, dtype=np.float64).reshape(-1, 3)),
+        "scale": np.broadcast_to(np.asarray(scales, dtype=np.float64), (count,)).copy(),
+        "speed": np.full(count, float(forwardSpeed)),
+        "escapeTimeout": np.zeros(count),
+        "targetIncidence": np.full((count, 3, 2, 2), np.nan),
+        "targetDirection": np.full((count, 3), np.nan),
+    }
+
+
+class SwarmEngine:
+
+    # Structure of arrays version of the FishActor behaviour:
+    # all fish are updated with batched numpy operations and the scene graph
+    # only needs to receive the resulting pos/hpr once per frame.
+    # The orientation of a fish is the unit direction it swims to: the
+    # influences are rotations of that direction (FOV tests are dot
+    # products), HPR are only computed for the rendering.
+    # Fish are stored in slots (see SlotTable) : they can be spawned and
+    # despawned while the simulation runs, the despawned ones are left out
+    # of the grid and of the steps until their slot is reused.
+
+    def __init__(self, positions, hprs, scales, gridDimentions, forwardSpeed=25):
+
+        state = initialFishState(positions, hprs, scales, forwardSpeed)
+        self.forwardSpeed = float(forwardSpeed)
+        self.pos = state["pos"]
+        # number of slots (alive or free)
+        self.count = len(self.pos)
+        self.slots = SlotTable(self.count)
+        # unit direction each fish is swimming to (local X axis of its node)
+        self.forward = state["forward"]
+        # state before the last step, to interpolate the rendering
+        self.prevPos = self.pos.copy()
+        self.prevForward = self.forward.copy()
+        # uniform scaling of each fish node
+        self.scale = state["scale"]
+        # speed along the local X axis (FishActor.speedVec)
+        self.speed = state["speed"]
+        # remaining escape time (seconds)
+        self.escapeTimeout = state["escapeTimeout"]
+        # [fish, dim, side] => [head, roll], NaN when no avoidance move in progress (BoxBoundary)
+        self.targetIncidence = state["targetIncidence"]
+        # direction of the avoidance move in progress, NaN when none (FieldBoundary)
+        self.targetDirection = state["targetDirection"]
+
+        self.gridDimentions = gridDimentions
+        self.grid = SpatialHash(gridDimentions)
+        self.neighbourQuery = NeighbourQuery(self.grid)
+        self.neighbourLists = VerletNeighbourList(self.neighbourQuery, NEIGHBOUR_LIST_EXTRA)
+        self.neighbours = np.full((self.count, 0), -1, dtype=np.int64)
+        # kernels of the fish behaviour (see backends.selectBackend)
+        self.backend = NumpyBackend()
+        # walls of the tank, None : box of the tankDimensions given to step
+        self.boundary = None
+        # simulation level of detail (see lod.SimulationLod), None : every fish updated every step
+        self.lod = None
+
+        # debug vectors are only computed when requested
+        self.recordVectors = False
+        self.vectors = None
+        self._vectorParts = []
+
+        # timings of the phases of a step, disabled unless a profiler is given
+        self.profiler = PhaseProfiler(enabled=False)
+
+    @property
+    def hpr(self):
+        # HPR of the nodes (computed, the state is forward)
+        return directionsToHpr(self.forward)
+
+    @property
+    def alive(self):
+        # mask of the slots holding a fish
+        return self.slots.alive
+
+    def spawn(self, positions, hprs, scales):
+        # add fish to the running swarm, returns their slot ids
+        state = initialFishState(positions, hprs, scales, self.forwardSpeed)
+        ids = self.slots.allocate(len(state["pos"]))
+        self._grow(self.slots.capacity)
+        for field, values in state.items():
+            getattr(self, field)[ids] = values
+        # no interpolation from the previous state of the slot
+        self.prevPos[ids] = state["pos"]
+        self.prevForward[ids] = state["forward"]
+        return ids
+
+    def despawn(self, ids):
+        # remove fish from the swarm : left where they are until their slot is reused
+        return self.slots.release(ids)
+
+    def _grow(self, capacity):
+        extra = capacity - self.count
+        if extra <= 0:
+            return
+        for field, fill in (("pos", 0), ("prevPos", 0), ("forward", 0), ("prevForward", 0), ("scale", 1),
+                            ("speed", 0), ("escapeTimeout", 0), ("targetIncidence", np.nan), ("targetDirection", np.nan)):
+            values = getattr(self, field)
+            setattr(self, field, np.concatenate([values, np.full((extra,) + values.shape[1:], fill, dtype=np.float64)]))
+        self.count = capacity
+
+    def neighbourRadius(self):
+        # neighbours further than this can not influence a fish
+        return CONFIG["fishAttractdRadius"] * self.scale[self.alive].max(initial=0)
+
+    def neighbourSkin(self):
+        # margin of the neighbour lists beyond neighbourRadius
+        return NEIGHBOUR_SKIN * self.scale[self.alive].max(initial=0)
+
+    def computeInfluence(self, fishIdx, neighbours, dt, environment=None):
+
+        rows, cols = np.nonzero(neighbours >= 0)
+        fish = fishIdx[rows]
+        others = neighbours[rows, cols]
+        # NodePath.get_distance is expressed in the neighbour referential
+        d = np.linalg.norm(self.pos[others] - self.pos[fish], axis=1) / self.scale[others]
+        kinds = self.backend.classifyNeighbours(
+            d, CONFIG["fishCollisionRadius"], CONFIG["fishAlignRadius"], CONFIG["fishAttractdRadius"])
+        influencing = kinds >= 0
+        others = others[influencing]
+        pairs = [(fish[influencing], self.pos[others], self.forward[others], kinds[influencing])]
+
+        # environment objects (EnvironmentIndex) : attractors and repulsors are only
+        # seen within INTERACTION_MAX_RADIUS, aligners interact with every fish
+        if environment is not None:
+            queryPos = self.pos[fishIdx]
+            for key, kind in (("aligners", PAIR_ALIGNER), ("attractors", PAIR_ATTRACTOR), ("repulsors", PAIR_REPULSOR)):
+                radius = None if key == "aligners" else INTERACTION_MAX_RADIUS
+                rows, objects = environment.query(key, queryPos, radius)
+                if len(objects) > 0:
+                    pairs.append((fishIdx[rows], environment.pos[objects], hprToDirections(environment.hpr[objects]),
+                                  np.full(len(objects), kind)))
+
+        fish, targetPos, targetForward, kinds = [np.concatenate(parts) for parts in zip(*pairs)]
+        # only what the fish can see: FOV and INTERACTION_MAX_RADIUS
+        rotation, visible = self.backend.pairSteering(kinds, targetPos - self.pos[fish], self.forward[fish],
+                                                      targetForward, CONFIG["FOV"], INTERACTION_MAX_RADIUS)
+        for kind, vector in ((PAIR_ALIGNER, VECTOR_ALIGNER), (PAIR_ATTRACTOR, VECTOR_ATTRACTOR), (PAIR_REPULSOR, VECTOR_REPULSOR)):
+            shown = visible & (kinds == kind)
+            self._recordVectors(fish[shown], targetPos[shown], vector)
+
+        turn = np.zeros((self.count, 3))
+        for axis in range(3):
+            turn[:, axis] = np.bincount(fish, weights=rotation[:, axis], minlength=self.count)
+
+        # Apply changes : bounded rotation of the directions
+        self.forward[fishIdx] = self.backend.rotate(self.forward[fishIdx], turn[fishIdx], dt * CONFIG["cohesion"],
+                                                    np.radians(MAX_TURN_RATE) * dt, MAX_ELEVATION)
+
+    def _recordVectors(self, fish, targetPos, kind):
+        # vectors are stored relative to the fish, like the arrows of FishActor
+        if self.recordVectors:
+            self._vectorParts.append((fish, targetPos - self.pos[fish], np.full(len(fish), kind)))
+
+    def _buildVectors(self, globalSpeed, fishIdx):
+        self._recordVectors(fishIdx, self.pos[fishIdx] + globalSpeed[fishIdx] * SPEED_VECTOR_RATIO, VECTOR_SPEED)
+        fish, deltas, kinds = [np.concatenate(parts) for parts in zip(*self._vectorParts)]
+        starts = self.pos[fish]
+        self.vectors = (starts, starts + deltas, kinds)
+        self._vectorParts = []
+
+    def stayInTank(self, fishIdx, globalSpeed, tankDimensions, dt):
+        # the box of tankDimensions unless another boundary (e.g. a FieldBoundary) is set
+        boundary = self.boundary if self.boundary is not None else BoxBoundary(tankDimensions)
+        boundary.stayInTank(self, fishIdx, globalSpeed, dt)
+
+    def interpolate(self, alpha):
+        # render state between the previous and the current step (alpha in [0,1])
+        return interpolateDirections(self.prevPos, self.prevForward, self.pos, self.forward, alpha)
+
+    def close(self):
+        pass
+
+    def step(self, dt, tankDimensions, environment=None, fishIdx=None, visible=None):
+        # fishIdx : fish to update (all the live ones by default)
+        # visible : mask of the fish that can be seen as neighbours (all the live ones by default),
+        #           the state of the other fish is not used
+
+        self.prevPos[:] = self.pos
+        self.prevForward[:] = self.forward
+
+        if fishIdx is None:
+            fishIdx = self.slots.liveIdx()
+        visible = self.alive if visible is None else visible & self.alive
+        # speed in the global referential, taking the node scaling into account
+        globalSpeed = self.forward * (self.speed * self.scale)[:, None]
+
+        # do not distruct trajectory when fish is escaping collision
+        escaping = self.escapeTimeout[fishIdx] > 0
+        self.escapeTimeout[fishIdx[escaping]] -= dt
+        active = fishIdx[~escaping]
+
+        # fish computing their influences this step : the near ones and a batch
+        # of the far ones, over the time since their last update
+        if self.lod is not None:
+            near, batch = self.lod.select(self.pos, active)
+        else:
+            near, batch = active, active[:0]
+        updated = np.concatenate([near, batch])
+
+        profiler = self.profiler
+        if self.lod is not None:
+            profiler.count("lodNear", self.lod.nearCount)
+            profiler.count("lodBatch", self.lod.batchCount)
+        with profiler.phase("spatialDistribution"):
+            self.grid.update(self.pos, visible)
+        if len(updated) > 0:
+            with profiler.phase("neighbours"):
+                self.neighbours = self.neighbourLists.kNearestBatch(
+                    self.pos, updated, CONFIG["neighbours"], self.neighbourRadius(), self.neighbourSkin())
+            profiler.count("neighboursExamined", self.neighbourLists.examined)
+            profiler.count("neighbourListBuilds", int(self.neighbourLists.rebuilt))
+            profiler.setLevel("neighbourListHitRate", self.neighbourLists.hitRate())
+            profiler.count("influenceUpdates", len(updated))
+            neighbours = self.neighbours
+            with profiler.phase("computeInfluence"):
+                if len(near) > 0:
+                    self.computeInfluence(near, neighbours[:len(near)], dt, environment)
+                if len(batch) > 0:
+                    self.computeInfluence(batch, neighbours[len(near):], dt * self.lod.period, environment)
+        # the walls are checked every step
+        if len(active) > 0:
+            with profiler.phase("stayInTank"):
+                self.stayInTank(active, globalSpeed, tankDimensions, dt)
+
+        # Move with the resulting speed
+        with profiler.phase("move"):
+            self.pos[fishIdx] += globalSpeed[fishIdx] * dt
+
+        self.vectors = None
+        if self.recordVectors:
+            self._buildVectors(globalSpeed, fishIdx)
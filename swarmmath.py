@@ -0,0 +1,92 @@
+import numpy as np
+
+# fish do not swim more up / down than this (degrees), like the roll limit of FishActor.safeSetHpr
+MAX_ELEVATION = 45
+
+
+def normAngles(angles):
+    # vectorized fish.normAngle : maps angles to ]-180, 180]
+    angles = np.mod(angles, 360.0)
+    return np.where(angles > 180, angles - 360.0, angles)
+
+
+def fastestPaths(target, start):
+    # vectorized FishActor._fastestPath
+    delta = target - start
+    candidates = np.stack([delta, delta + 360.0, delta - 360.0])
+    choice = np.argmin(np.abs(candidates), axis=0)
+    return np.take_along_axis(candidates, choice[None], axis=0)[0]
+
+
+def hprToMatrices(hpr):
+    # rotation part of the Panda3D transform of each HPR (row vector convention)
+    # row 0 is the local X axis : the direction the fish is swimming to
+    h, p, r = np.radians(hpr).T
+    ch, sh = np.cos(h), np.sin(h)
+    cp, sp = np.cos(p), np.sin(p)
+    cr, sr = np.cos(r), np.sin(r)
+    rot = np.empty((len(hpr), 3, 3))
+    rot[:, 0, 0] = cr * ch - sr * sp * sh
+    rot[:, 0, 1] = cr * sh + sr * sp * ch
+    rot[:, 0, 2] = -sr * cp
+    rot[:, 1, 0] = -cp * sh
+    rot[:, 1, 1] = cp * ch
+    rot[:, 1, 2] = sp
+    rot[:, 2, 0] = sr * ch + cr * sp * sh
+    rot[:, 2, 1] = sr * sh - cr * sp * ch
+    rot[:, 2, 2] = cr * cp
+    return rot
+
+
+def interpolateState(prevPos, prevHpr, pos, hpr, alpha):
+    # state between two steps (alpha in [0,1]), headings take the shortest path
+    if alpha >= 1:
+        return pos, hpr
+    return prevPos + (pos - prevPos) * alpha, prevHpr + normAngles(hpr - prevHpr) * alpha
+
+
+def hprToDirections(hpr):
+    # local X axis of each HPR (row 0 of hprToMatrices) : the direction the fish is swimming to
+    h, p, r = np.radians(hpr).T
+    ch, sh = np.cos(h), np.sin(h)
+    cp, sp = np.cos(p), np.sin(p)
+    cr, sr = np.cos(r), np.sin(r)
+    return np.stack([cr * ch - sr * sp * sh, cr * sh + sr * sp * ch, -sr * cp], axis=1)
+
+
+def directionsToHpr(directions):
+    # HPR (no pitch) of fish swimming along unit directions, inverse of hprToDirections :
+    # the roll of the fish model is what makes it swim up or down
+    hpr = np.zeros((len(directions), 3))
+    hpr[:, 0] = np.degrees(np.arctan2(directions[:, 1], directions[:, 0]))
+    hpr[:, 2] = np.degrees(-np.arcsin(np.clip(directions[:, 2], -1, 1)))
+    return hpr
+
+
+def normalize(vectors):
+    return vectors / np.maximum(np.linalg.norm(vectors, axis=1), 1e-12)[:, None]
+
+
+def clampElevation(directions, maxElevation):
+    # limit the up / down angle of unit directions (degrees), the heading is kept
+    limit = np.sin(np.radians(maxElevation))
+    z = np.clip(directions[:, 2], -limit, limit)
+    horizontal = np.linalg.norm(directions[:, :2], axis=1)
+    scale = np.sqrt(1 - z * z) / np.maximum(horizontal, 1e-12)
+    clamped = np.stack([directions[:, 0] * scale, directions[:, 1] * scale, z], axis=1)
+    # straight up / down : no heading to keep
+    clamped[horizontal < 1e-12] = (np.sqrt(1 - limit * limit), 0, 0)
+    return clamped
+
+
+def interpolateDirections(prevPos, prevForward, pos, forward, alpha):
+    # render state (positions, HPR) between two steps (alpha in [0,1]),
+    # the only conversion of the swim directions to HPR
+    if alpha < 1:
+        pos = prevPos + (pos - prevPos) * alpha
+        blended = prevForward + (forward - prevForward) * alpha
+        # a fish reflected by a wall may turn back at once : no direction in between
+        reversed = np.linalg.norm(blended, axis=1) < 1e-6
+        blended[reversed] = forward[reversed]
+        forward = normalize(blended)
+    return pos, directionsToHpr(forward)
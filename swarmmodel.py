@@ -0,0 +1,67 @@
+import numpy as np
+
+from swarmcore import INTERACTION_MAX_RADIUS, FISH_SCALE, randomFishHpr, computeGridDimentions
+from boundary import BoxShape, CylinderShape, BoxBoundary, FieldBoundary, DistanceField
+from environment import EnvironmentIndex
+from swarmengine import SwarmEngine
+
+
+def mkTankShape(tankShape, dimensions):
+    # tankShape : "box" or "cylinder" (vertical, inscribed in dimensions)
+    if tankShape == "cylinder":
+        return CylinderShape(min(dimensions[0], dimensions[1]), dimensions[2])
+    if tankShape != "box":
+        raise ValueError(f"Unknown tank shape {tankShape}")
+    return BoxShape(dimensions)
+
+
+def mkBoundary(dimensions, tankShape="box", obstacles=(), distanceField=True):
+    # walls and obstacles of the tank as seen by the SwarmEngine
+    if tankShape == "box" and not obstacles and not distanceField:
+        return BoxBoundary(dimensions)
+    return FieldBoundary(DistanceField(mkTankShape(tankShape, dimensions), list(obstacles)))
+
+
+class SwarmModel:
+
+    # A swarm in a tank, stepped without Panda3D (no window, no nodes).
+    # It holds what the SwarmEngine needs around the fish : the boundary of
+    # the tank, the size of the spatial grid and the environment objects.
+
+    def __init__(self, layout, dimensions, tankShape="box", obstacles=(), distanceField=True,
+                 scale=FISH_SCALE, backend=None, hprs=None, boundary=None):
+        # layout : initial positions, dimensions : half lengths of the tank
+        # boundary : boundary of the same tank reused from another model (built otherwise)
+
+        self.dimensions = tuple(float(d) for d in dimensions)
+        self.tank = mkTankShape(tankShape, self.dimensions)
+        if boundary is None:
+            boundary = mkBoundary(self.dimensions, tankShape, obstacles, distanceField)
+        self.boundary = boundary
+        self.gridDimentions = computeGridDimentions(self.dimensions)
+        # objects hashed in cubes : a fish only examines the objects in its range
+        self.environment = EnvironmentIndex(INTERACTION_MAX_RADIUS)
+
+        if hprs is None:
+            hprs = [randomFishHpr() for _ in layout]
+        self.engine = SwarmEngine(layout, hprs, scale, self.gridDimentions)
+        self.engine.boundary = self.boundary
+        if backend is not None:
+            self.engine.backend = backend
+        self.time = 0.0
+
+    def step(self, dt):
+        self.engine.step(dt, self.dimensions, self.environment)
+        self.time += dt
+
+    def run(self, steps, dt):
+        for _ in range(steps):
+            self.step(dt)
+
+    def escaped(self, margin=0.0):
+        # mask of the live fish further than margin outside of the tank (or lost : NaN position)
+        pos = self.engine.pos[self.engine.alive]
+        return ~(self.tank.distance(pos) <= margin)
+
+    def close(self):
+        self.engine.close()
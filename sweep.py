@@ -0,0 +1,282 @@
+import argparse
+import csv
+import itertools
+import json
+import math
+import multiprocessing
+import os
+import random
+import sys
+import time
+import traceback
+
+import numpy as np
+
+from swarmcore import CONFIG, INTERACTION_MAX_RADIUS, FISH_SCALE
+from swarmmodel import SwarmModel, mkBoundary, mkTankShape
+from backends import selectBackend
+
+# tank of the application (half lengths)
+DEFAULT_TANK = (1600, 900, 200)
+TANK_SHAPES = ["box", "cylinder"]
+# the fish of the random layout start at least this far from the walls
+LAYOUT_MARGIN = 20
+# runs of the default CONFIG per tank shape of --check
+CHECK_RUNS = 4
+
+# the state of the swarm is checked every CHECK_INTERVAL steps
+CHECK_INTERVAL = 30
+# the schooling metrics are averaged over the checks of the last part of the run
+WARMUP_RATIO = 0.5
+# a fish further than ESCAPE_MARGIN outside of the tank escaped
+ESCAPE_MARGIN = 50
+
+METRICS = ["polarization", "nearestDistance", "isolated", "spread"]
+
+# SwarmModel settings reused by the runs of a worker process : (boundary key, boundary, backend)
+_workerState = {}
+
+
+def parseValue(text):
+    # CONFIG value : int when possible, float otherwise
+    try:
+        return int(text)
+    except ValueError:
+        return float(text)
+
+
+def parseParameters(specs, separator):
+    # ["name=<values>", ...] => {name: values}, values split by the caller
+    params = {}
+    for spec in specs:
+        name, _, values = spec.partition("=")
+        if name not in CONFIG:
+            raise ValueError(f"Unknown CONFIG parameter {name} (choose from {', '.join(CONFIG)})")
+        if not values:
+            raise ValueError(f"No value for {name} (expected {name}=<values>)")
+        params[name] = [parseValue(v) for v in values.split(separator)]
+    return params
+
+
+def gridSamples(params):
+    # every combination of the values : {name: [v1, v2...]}
+    names = list(params)
+    return [dict(zip(names, values)) for values in itertools.product(*(params[name] for name in names))]
+
+
+def randomSamples(params, count, rng):
+    # count uniform samples in the ranges : {name: [low, high]}, integers when both bounds are
+    samples = [{} for _ in range(count)]
+    for name, bounds in params.items():
+        if len(bounds) != 2:
+            raise ValueError(f"Expected a range {name}=<low>:<high>")
+        low, high = bounds
+        if isinstance(low, int) and isinstance(high, int):
+            values = rng.integers(low, high, count, endpoint=True).tolist()
+        else:
+            values = rng.uniform(low, high, count).tolist()
+        for sample, value in zip(samples, values):
+            sample[name] = value
+    return samples
+
+
+def randomLayout(count, tank, dimensions, rng):
+    # count positions inside the tank shape : candidates drawn in its box, the ones
+    # closer than LAYOUT_MARGIN to a wall (or outside) are drawn again
+    positions = np.zeros((0, 3))
+    while len(positions) < count:
+        candidates = rng.uniform(-1, 1, (2 * count, 3)) * np.array(dimensions)
+        positions = np.concatenate([positions, candidates[tank.distance(candidates) < -LAYOUT_MARGIN]])
+    return [tuple(p) for p in positions[:count]]
+
+
+def schoolingMetrics(engine):
+    # polarization : norm of the mean direction (1 : all the fish swim the same way)
+    # nearestDistance : mean distance to the nearest fish, isolated : fraction of the
+    # fish without any other fish in INTERACTION_MAX_RADIUS, spread : mean distance to the centroid
+    alive = engine.slots.liveIdx()
+    pos = engine.pos
+    engine.grid.update(pos, engine.alive)
+    nearest = engine.neighbourQuery.kNearestBatch(pos, alive, 1, INTERACTION_MAX_RADIUS)[:, 0]
+    found = nearest >= 0
+    distances = np.linalg.norm(pos[alive[found]] - pos[nearest[found]], axis=1)
+    return {
+        "polarization": float(np.linalg.norm(engine.forward[alive].mean(axis=0))),
+        "nearestDistance": float(distances.mean()) if len(distances) else math.nan,
+        "isolated": float(1 - found.mean()),
+        "spread": float(np.linalg.norm(pos[alive] - pos[alive].mean(axis=0), axis=1).mean()),
+    }
+
+
+def _workerModel(settings, layout):
+    # the boundary (distance field) and the backend are built once per process
+    key = (tuple(settings["tank"]), settings["tankShape"], settings["distanceField"])
+    if _workerState.get("key") != key:
+        _workerState["key"] = key
+        _workerState["boundary"] = mkBoundary(settings["tank"], settings["tankShape"], (), settings["distanceField"])
+    if "backend" not in _workerState:
+        _workerState["backend"] = selectBackend(settings["backend"])
+    return SwarmModel(layout, settings["tank"], settings["tankShape"], distanceField=settings["distanceField"],
+                      scale=FISH_SCALE, backend=_workerState["backend"], boundary=_workerState["boundary"])
+
+
+def runPoint(run):
+    # one simulation of the sweep : (index, CONFIG values, settings) => row of the results table
+    index, params, settings = run
+    row = {"run": index, **params}
+    try:
+        CONFIG.clear()
+        CONFIG.update(settings["config"])
+        CONFIG.update(params)
+        seed = settings["seed"] + index
+        random.seed(seed)
+        rng = np.random.default_rng(seed)
+        tank = mkTankShape(settings["tankShape"], settings["tank"])
+        model = _workerModel(settings, randomLayout(settings["fish"], tank, settings["tank"], rng))
+
+        steps, dt = settings["steps"], settings["dt"]
+        samples = []
+        escaped = 0
+        diverged = False
+        start = time.perf_counter()
+        done = 0
+        while done < steps:
+            chunk = min(CHECK_INTERVAL, steps - done)
+            model.run(chunk, dt)
+            done += chunk
+            escaped = int(np.count_nonzero(model.escaped(ESCAPE_MARGIN)))
+            if escaped > settings["maxEscaped"] * model.engine.count:
+                # the parameters do not keep the fish in the tank : not worth running further
+                diverged = True
+                break
+            if done >= WARMUP_RATIO * steps:
+                samples.append(schoolingMetrics(model.engine))
+        elapsed = time.perf_counter() - start
+        model.close()
+
+        row.update(fish=model.engine.count, steps=done, diverged=diverged, escaped=escaped)
+        for name in METRICS:
+            row[name] = float(np.mean([sample[name] for sample in samples])) if samples else math.nan
+        row["stepsPerSec"] = done / elapsed if elapsed > 0 else math.inf
+        row["seconds"] = elapsed
+        row["error"] = ""
+    except Exception:
+        row.update(diverged=True, error=traceback.format_exc().strip().splitlines()[-1])
+    return row
+
+
+def runSweep(samples, settings, workers):
+    # rows of the results table, in the order of the samples
+    runs = [(index, params, settings) for index, params in enumerate(samples)]
+    rows = []
+    start = time.perf_counter()
+    if workers <= 1:
+        results = map(runPoint, runs)
+        pool = None
+    else:
+        # like the swarm shards : fresh worker processes
+        pool = multiprocessing.get_context("spawn").Pool(workers)
+        results = pool.imap_unordered(runPoint, runs)
+    try:
+        for row in results:
+            rows.append(row)
+            status = "error" if row["error"] else ("diverged" if row["diverged"] else "ok")
+            print(f"run {row['run']:>4} [{len(rows)}/{len(runs)}] {status:<8} "
+                  + " ".join(f"{name}={row[name]:g}" for name in samples[row["run"]]))
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+    elapsed = time.perf_counter() - start
+    print(f"{len(rows)} runs in {elapsed:.1f}s ({len(rows) / elapsed * 3600:.0f} runs/hour)")
+    return sorted(rows, key=lambda row: row["run"])
+
+
+def formatTable(rows, params):
+    columns = ["run"] + list(params) + ["diverged", "escaped"] + METRICS + ["stepsPerSec"]
+    lines = [" ".join(f"{column:>15}" for column in columns)]
+    for row in rows:
+        lines.append(" ".join(f"{row.get(column, ''):>15.4g}" if isinstance(row.get(column), float)
+                              else f"{str(row.get(column, '')):>15}" for column in columns))
+    return "\n".join(lines)
+
+
+def writeResults(path, rows, settings):
+    if path.endswith(".csv"):
+        columns = []
+        for row in rows:
+            columns.extend(key for key in row if key not in columns)
+        with open(path, "w", newline="") as f:
+            writer = csv.DictWriter(f, fieldnames=columns)
+            writer.writeheader()
+            writer.writerows(rows)
+    else:
+        with open(path, "w") as f:
+            json.dump({"settings": settings, "results": rows}, f, indent=2)
+    print(f"Results of {len(rows)} runs written to {path}")
+
+
+def parseArguments(argv):
+    parser = argparse.ArgumentParser(description="Run headless swarms over a grid or a random sample of CONFIG values")
+    group = parser.add_mutually_exclusive_group(required=True)
+    group.add_argument("--grid", nargs="+", metavar="NAME=V1,V2", help="values of each parameter, every combination is run")
+    group.add_argument("--random", nargs="+", metavar="NAME=LOW:HIGH", help="ranges of the parameters, sampled uniformly")
+    group.add_argument("--check", action="store_true", help="run the default CONFIG in every tank shape, fails if a run diverges")
+    parser.add_argument("--samples", type=int, default=100, help="number of random samples")
+    parser.add_argument("--fish", type=int, default=200, help="number of fish of each run (random layout)")
+    parser.add_argument("--steps", type=int, default=1800, help="steps of each run")
+    parser.add_argument("--dt", type=float, default=1/60, help="simulation time step (seconds)")
+    parser.add_argument("--tank", type=float, nargs=3, default=DEFAULT_TANK, metavar=("X", "Y", "Z"), help="half lengths of the tank")
+    parser.add_argument("--tank-shape", choices=TANK_SHAPES, default="box", help="shape of the tank")
+    parser.add_argument("--box-boundary", action="store_true", help="face by face box boundary instead of the distance field")
+    parser.add_argument("--max-escaped", type=float, default=0.01, help="fraction of escaped fish stopping a run as diverged")
+    parser.add_argument("--backend", choices=["auto", "numpy", "python", "numba"], default="auto", help="kernels of the SwarmEngine")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="worker processes (1 : no pool)")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the samples and of the layouts")
+    parser.add_argument("--output", default="sweep.csv", help="result table (.csv or .json)")
+    return parser.parse_args(argv)
+
+
+def mkSettings(args, tankShape):
+    return {
+        "config": dict(CONFIG),
+        "fish": args.fish,
+        "steps": args.steps,
+        "dt": args.dt,
+        "tank": list(args.tank),
+        "tankShape": tankShape,
+        "distanceField": not args.box_boundary,
+        "maxEscaped": args.max_escaped,
+        "backend": args.backend,
+        "seed": args.seed,
+    }
+
+
+def checkDefaults(args):
+    # the default CONFIG must keep the fish in every tank shape : True when no run diverged
+    passed = True
+    for tankShape in TANK_SHAPES:
+        rows = runSweep([{}] * CHECK_RUNS, mkSettings(args, tankShape), args.workers)
+        failed = [row for row in rows if row["diverged"]]
+        for row in failed:
+            print(f"{tankShape} tank : run {row['run']} diverged ({row.get('escaped')} fish escaped) {row['error']}")
+        passed = passed and not failed
+    print("Check passed" if passed else "Check failed")
+    return passed
+
+
+if __name__ == "__main__":
+    args = parseArguments(sys.argv[1:])
+    if args.check:
+        sys.exit(0 if checkDefaults(args) else 1)
+    rng = np.random.default_rng(args.seed)
+    if args.grid:
+        params = parseParameters(args.grid, ",")
+        samples = gridSamples(params)
+    else:
+        params = parseParameters(args.random, ":")
+        samples = randomSamples(params, args.samples, rng)
+    settings = mkSettings(args, args.tank_shape)
+    rows = runSweep(samples, settings, args.workers)
+    print(formatTable(rows, params))
+    writeResults(args.output, rows, settings)
@@ -0,0 +1,156 @@
+import bisect
+import json
+import math
+import struct
+
+import numpy as np
+
+TRAJECTORY_MAGIC = b"FISHTRAJ"
+TRAJECTORY_VERSION = 1
+
+# recorded state of each fish per frame : (name, dtype, shape of one fish)
+TRAJECTORY_FIELDS = [
+    ("pos", "<f4", (3,)),
+    ("hpr", "<f4", (3,)),
+    ("speed", "<f4", ()),
+    ("cell", "<i4", ()),
+    ("escapeTimeout", "<f4", ()),
+    # 0 for the free slots of despawned fish (files without it : every fish alive)
+    ("alive", "|u1", ()),
+]
+
+# chunk header : number of frames of the chunk
+CHUNK_HEADER = struct.Struct("<I4x")
+
+
+def _fieldBytes(count, dtype, shape):
+    return count * np.dtype(dtype).itemsize * math.prod(shape)
+
+
+def _chunkPadding(size):
+    return -size % 4
+
+
+class TrajectoryWriter:
+
+    # Appends the swarm state of every step to a columnar binary file.
+    # The file is a header (count, dt, scale of each fish) followed by chunks
+    # of frames, each chunk storing the fields one after the other so that
+    # a field of a chunk is a contiguous (frames, count, ...) array.
+    # Frames are buffered and written a whole chunk at a time.
+
+    def __init__(self, path, count, scale, dt, chunkFrames=256):
+        self.path = path
+        self.count = count
+        self.chunkFrames = chunkFrames
+        self.frameCount = 0
+
+        self.buffers = {name: np.zeros((chunkFrames, count) + shape, dtype=dtype)
+                        for name, dtype, shape in TRAJECTORY_FIELDS}
+        self.buffered = 0
+
+        header = json.dumps({
+            "version": TRAJECTORY_VERSION,
+            "count": count,
+            "dt": dt,
+            "fields": [[name, dtype, list(shape)] for name, dtype, shape in TRAJECTORY_FIELDS],
+        }).encode()
+        # keeps the arrays 4 bytes aligned
+        header += b" " * (-(len(TRAJECTORY_MAGIC) + 4 + len(header)) % 4)
+        self.file = open(path, "wb")
+        self.file.write(TRAJECTORY_MAGIC)
+        self.file.write(struct.pack("<I", len(header)))
+        self.file.write(header)
+        self.file.write(np.broadcast_to(np.asarray(scale, dtype="<f4"), (count,)).tobytes())
+
+    def append(self, **state):
+        # one frame : an array per field of TRAJECTORY_FIELDS
+        for name, _, _ in TRAJECTORY_FIELDS:
+            self.buffers[name][self.buffered] = state[name]
+        self.buffered += 1
+        self.frameCount += 1
+        if self.buffered == self.chunkFrames:
+            self.flush()
+
+    def flush(self):
+        if self.buffered == 0:
+            return
+        self.file.write(CHUNK_HEADER.pack(self.buffered))
+        size = 0
+        for name, _, _ in TRAJECTORY_FIELDS:
+            data = self.buffers[name][:self.buffered].tobytes()
+            self.file.write(data)
+            size += len(data)
+        # keeps the next chunk 4 bytes aligned
+        self.file.write(b"\0" * _chunkPadding(size))
+        self.file.flush()
+        self.buffered = 0
+
+    def close(self):
+        if self.file.closed:
+            return
+        self.flush()
+        self.file.close()
+        print(f"{self.frameCount} frames of {self.count} fish recorded in {self.path}")
+
+
+class TrajectoryReader:
+
+    # Memory mapped access to a file written by TrajectoryWriter :
+    # any frame is available without reading the previous ones.
+
+    def __init__(self, path):
+        self.path = path
+        self.data = np.memmap(path, dtype=np.uint8, mode="r")
+
+        if bytes(self.data[:len(TRAJECTORY_MAGIC)]) != TRAJECTORY_MAGIC:
+            raise ValueError(f"{path} is not a trajectory file")
+        offset = len(TRAJECTORY_MAGIC)
+        (headerSize,) = struct.unpack_from("<I", self.data, offset)
+        offset += 4
+        header = json.loads(bytes(self.data[offset:offset + headerSize]))
+        offset += headerSize
+        if header["version"] != TRAJECTORY_VERSION:
+            raise ValueError(f"Unsupported trajectory version {header['version']}")
+
+        self.count = header["count"]
+        self.dt = header["dt"]
+        self.fields = [(name, dtype, tuple(shape)) for name, dtype, shape in header["fields"]]
+        self.scale = np.ndarray((self.count,), dtype="<f4", buffer=self.data, offset=offset)
+        offset += _fieldBytes(self.count, "<f4", ())
+
+        # first frame of each chunk and the arrays of its fields
+        self.chunkStarts = []
+        self.chunks = []
+        self.frameCount = 0
+        while offset + CHUNK_HEADER.size <= len(self.data):
+            (frames,) = CHUNK_HEADER.unpack_from(self.data, offset)
+            offset += CHUNK_HEADER.size
+            chunk = {}
+            start = offset
+            for name, dtype, shape in self.fields:
+                size = frames * _fieldBytes(self.count, dtype, shape)
+                if offset + size > len(self.data):
+                    # truncated chunk (recording interrupted)
+                    chunk = None
+                    break
+                chunk[name] = np.ndarray((frames, self.count) + shape, dtype=dtype, buffer=self.data, offset=offset)
+                offset += size
+            if chunk is None:
+                break
+            offset += _chunkPadding(offset - start)
+            self.chunkStarts.append(self.frameCount)
+            self.chunks.append(chunk)
+            self.frameCount += frames
+
+    def frame(self, idx):
+        # field name => array of the frame (views on the file)
+        if not 0 <= idx < self.frameCount:
+            raise IndexError(f"Frame {idx} out of range (0-{self.frameCount - 1})")
+        chunk = bisect.bisect_right(self.chunkStarts, idx) - 1
+        local = idx - self.chunkStarts[chunk]
+        return {name: values[local] for name, values in self.chunks[chunk].items()}
+
+    def close(self):
+        self.chunks = []
+        self.data = None